@@ -1,7 +1,315 @@
+import array
 import csv
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import struct
+import sys
+import tempfile
 import numpy as np
+from scipy import sparse
 import argparse
+try:
+    import instrument
+except ImportError:
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+    import instrument
 
+class RatingsStore(object):
+    """
+    ratings from a csv of the form:
+        user,movie,rating
+    read in a single pass and held in arrays instead of dicts of strings.
+    users and movies are mapped to dense integer ids in order of first appearance.
+    the ratings are kept twice, row-major by user (CSR) and column-major by movie (CSC),
+    so both "what did this user rate" and "who rated this movie" are array slices
+    attributes:
+        users, movies: lists mapping id -> original string
+        user_ids, movie_ids: dicts mapping original string -> id
+        indptr, indices, data: CSR layout, user u rated movies indices[indptr[u]:indptr[u+1]]
+            (sorted by movie id) with ratings data[indptr[u]:indptr[u+1]]
+        col_indptr, col_indices, col_data: CSC layout, movie m was rated by users
+            col_indices[col_indptr[m]:col_indptr[m+1]] (sorted by user id)
+        user_sums, user_counts, movie_sums, movie_counts: rating sums and counts per user/movie
+        total_sum, total_count: rating sum and count over every row
+        user_avgs, movie_avgs: arrays of the average rating per user/movie id
+        total_avg: average rating over every row
+    a user that rates the same movie twice keeps the last rating (like file_reader), while the
+    averages count every row (like get_averages)
+    """
+
+    def __init__(self, users, movies, user_rows, movie_rows, ratings):
+        """
+        :arg
+        users, movies, user_rows, movie_rows, ratings
+            users: list of user strings, position is the user id
+            movies: list of movie strings, position is the movie id
+            user_rows, movie_rows: integer arrays of user/movie id per csv row
+            ratings: float array of the rating per csv row
+        """
+        self.users = users
+        self.movies = movies
+        self.user_ids = dict((user, i) for i, user in enumerate(users))
+        self.movie_ids = dict((movie, i) for i, movie in enumerate(movies))
+        user_rows = np.asarray(user_rows, dtype=np.int32)
+        movie_rows = np.asarray(movie_rows, dtype=np.int32)
+        ratings = np.asarray(ratings, dtype=np.float64)
+        self.user_sums = np.bincount(user_rows, weights=ratings, minlength=len(users))
+        self.user_counts = np.bincount(user_rows, minlength=len(users))
+        self.movie_sums = np.bincount(movie_rows, weights=ratings, minlength=len(movies))
+        self.movie_counts = np.bincount(movie_rows, minlength=len(movies))
+        self.total_sum = float(ratings.sum())
+        self.total_count = len(ratings)
+        self._build_layouts(user_rows, movie_rows, ratings)
+        self.refresh_averages()
+
+    def _build_layouts(self, user_rows, movie_rows, ratings):
+        """fills the CSR and CSC layouts from per-row user ids, movie ids and ratings"""
+        self.indptr, self.indices, self.data = _compress(user_rows, movie_rows, ratings,
+                                                         len(self.users))
+        row_users = np.repeat(np.arange(len(self.users), dtype=np.int32), np.diff(self.indptr))
+        self.col_indptr, self.col_indices, self.col_data = _compress(self.indices, row_users,
+                                                                     self.data, len(self.movies))
+
+    def add_ratings(self, rows):
+        """
+        :arg
+        rows: iterable of (user, movie, rating) rows, new users and movies get the next free ids
+        :returns
+        (touched_users, touched_movies): sorted integer arrays of the ids that got new rows
+        the sums and counts are updated in place of a re-read, the new rows are inserted into
+        the sorted layouts (no re-sort of the existing ratings) and win over older ratings of
+        the same pair
+        """
+        user_rows = []
+        movie_rows = []
+        ratings = []
+        for row in rows:
+            uid = self.user_ids.get(row[0])
+            if uid is None:
+                uid = self.user_ids[row[0]] = len(self.users)
+                self.users.append(row[0])
+            mid = self.movie_ids.get(row[1])
+            if mid is None:
+                mid = self.movie_ids[row[1]] = len(self.movies)
+                self.movies.append(row[1])
+            user_rows.append(uid)
+            movie_rows.append(mid)
+            ratings.append(float(row[2]))
+        user_rows = np.array(user_rows, dtype=np.int32)
+        movie_rows = np.array(movie_rows, dtype=np.int32)
+        ratings = np.array(ratings, dtype=np.float64)
+        n_users = len(self.users)
+        n_movies = len(self.movies)
+        self.user_sums = (_grow(self.user_sums, n_users)
+                          + np.bincount(user_rows, weights=ratings, minlength=n_users))
+        self.user_counts = (_grow(self.user_counts, n_users)
+                            + np.bincount(user_rows, minlength=n_users))
+        self.movie_sums = (_grow(self.movie_sums, n_movies)
+                           + np.bincount(movie_rows, weights=ratings, minlength=n_movies))
+        self.movie_counts = (_grow(self.movie_counts, n_movies)
+                             + np.bincount(movie_rows, minlength=n_movies))
+        self.total_sum += float(ratings.sum())
+        self.total_count += len(ratings)
+        new_indptr, new_movies, new_ratings = _compress(user_rows, movie_rows, ratings, n_users)
+        new_users = np.repeat(np.arange(n_users, dtype=np.int32), np.diff(new_indptr))
+        self.indptr, self.indices, self.data = _merge(
+            (self.indptr, self.indices, self.data), new_users, new_movies, new_ratings, n_users, n_movies)
+        col_indptr, col_users, col_ratings = _compress(new_movies, new_users, new_ratings, n_movies)
+        col_movies = np.repeat(np.arange(n_movies, dtype=np.int32), np.diff(col_indptr))
+        self.col_indptr, self.col_indices, self.col_data = _merge(
+            (self.col_indptr, self.col_indices, self.col_data), col_movies, col_users, col_ratings,
+            n_movies, n_users)
+        self.refresh_averages()
+        return (np.unique(user_rows), np.unique(movie_rows))
+
+    @classmethod
+    @instrument.profiled('RatingsStore.from_csv', items=lambda store: int(store.total_count))
+    def from_csv(cls, filepath):
+        """
+        :arg
+        path to csv file, csv file will be of form:
+            user,movie,rating
+        :returns
+        a RatingsStore holding every row of the file, the file is only read once
+        """
+        users = []
+        movies = []
+        user_ids = {}
+        movie_ids = {}
+        user_rows = array.array('i')
+        movie_rows = array.array('i')
+        ratings = array.array('d')
+        with open(filepath, 'r') as infile:
+            reader = csv.reader(infile)
+            for rows in reader:
+                uid = user_ids.get(rows[0])
+                if uid is None:
+                    uid = user_ids[rows[0]] = len(users)
+                    users.append(rows[0])
+                mid = movie_ids.get(rows[1])
+                if mid is None:
+                    mid = movie_ids[rows[1]] = len(movies)
+                    movies.append(rows[1])
+                user_rows.append(uid)
+                movie_rows.append(mid)
+                ratings.append(float(rows[2]))
+        return cls(users, movies, np.frombuffer(user_rows, dtype=np.int32),
+                   np.frombuffer(movie_rows, dtype=np.int32), np.frombuffer(ratings, dtype=np.float64))
+
+    @classmethod
+    def from_arrays(cls, users, movies, arrays, total_sum, total_count):
+        """
+        :arg
+        users, movies, arrays, total_sum, total_count
+            users, movies: lists mapping id -> original string
+            arrays: dict holding every array attribute named in STORE_ARRAYS, and
+                optionally precomputed user_avgs and movie_avgs
+            total_sum, total_count: rating sum and count over every row
+        :returns
+        a RatingsStore wrapping the arrays as they are (they may be memory-mapped)
+        """
+        store = cls.__new__(cls)
+        store.users = users
+        store.movies = movies
+        store.user_ids = dict((user, i) for i, user in enumerate(users))
+        store.movie_ids = dict((movie, i) for i, movie in enumerate(movies))
+        for name in STORE_ARRAYS:
+            setattr(store, name, arrays[name])
+        store.total_sum = total_sum
+        store.total_count = total_count
+        if 'user_avgs' in arrays:
+            # saved averages: don't touch the (memory-mapped) sums and counts
+            store.user_avgs = arrays['user_avgs']
+            store.movie_avgs = arrays['movie_avgs']
+            store.total_avg = total_sum / total_count if total_count else float('nan')
+        else:
+            store.refresh_averages()
+        return store
+
+    def refresh_averages(self):
+        """recomputes user_avgs, movie_avgs and total_avg from the sums and counts"""
+        self.user_avgs = self.user_sums / self.user_counts
+        self.movie_avgs = self.movie_sums / self.movie_counts
+        self.total_avg = self.total_sum / self.total_count if self.total_count else float('nan')
+
+    def userset(self):
+        """set of all users"""
+        return set(self.users)
+
+    def movieset(self):
+        """set of all movies"""
+        return set(self.movies)
+
+    def fulldict(self):
+        """
+        :returns
+        csvdict: a dictionary of dict[user][movie] = rating, as in file_reader
+        """
+        csvdict = {}
+        for uid, user in enumerate(self.users):
+            start, stop = self.indptr[uid], self.indptr[uid + 1]
+            movies = [self.movies[mid] for mid in self.indices[start:stop]]
+            csvdict[user] = dict(zip(movies, self.data[start:stop].tolist()))
+        return csvdict
+
+    def averages(self):
+        """
+        :returns
+        (useravg, movieavg, totalavg) in a tuple, as in get_averages
+        """
+        useravg = dict(zip(self.users, self.user_avgs.tolist()))
+        movieavg = dict(zip(self.movies, self.movie_avgs.tolist()))
+        return (useravg, movieavg, self.total_avg)
+
+    def user_seen_sets(self):
+        """
+        :returns
+        usr_mv_sets: dict[user] = set of movies seen for that user, as in user_seen_sets
+        """
+        usr_mv_sets = {}
+        for uid, user in enumerate(self.users):
+            mids = self.indices[self.indptr[uid]:self.indptr[uid + 1]]
+            usr_mv_sets[user] = set(self.movies[mid] for mid in mids)
+        return usr_mv_sets
+
+    def films_user_sets(self):
+        """
+        :returns
+        movie_to_user: dict[movie] = set of users that have seen a movie, as in films_user_sets
+        """
+        movie_to_user = {}
+        for mid, movie in enumerate(self.movies):
+            uids = self.col_indices[self.col_indptr[mid]:self.col_indptr[mid + 1]]
+            movie_to_user[movie] = set(self.users[uid] for uid in uids)
+        return movie_to_user
+
+
+STORE_ARRAYS = ('indptr', 'indices', 'data', 'col_indptr', 'col_indices', 'col_data',
+                'user_sums', 'user_counts', 'movie_sums', 'movie_counts')
+
+
+def _grow(values, length):
+    """values padded with zeros up to length"""
+    return np.concatenate((values, np.zeros(length - len(values), dtype=values.dtype)))
+
+
+def _compress(major, minor, values, n_major):
+    """
+    :arg
+    major, minor, values, n_major
+        major: integer array of row ids
+        minor: integer array of column ids
+        values: float array of values
+        n_major: number of rows
+    :returns
+    (indptr, indices, data) compressed sparse layout sorted by (major, minor), when a
+    (major, minor) pair repeats only the value that came last is kept
+    """
+    order = np.lexsort((np.arange(len(major)), minor, major))
+    major = major[order]
+    minor = minor[order]
+    values = values[order]
+    keep = np.ones(len(major), dtype=bool)
+    keep[:-1] = (major[1:] != major[:-1]) | (minor[1:] != minor[:-1])
+    indptr = np.zeros(n_major + 1, dtype=np.int64)
+    np.cumsum(np.bincount(major[keep], minlength=n_major), out=indptr[1:])
+    return (indptr, minor[keep].astype(np.int32), values[keep].astype(np.float64))
+
+
+def _merge(layout, major, minor, values, n_major, n_minor):
+    """
+    :arg
+    layout, major, minor, values, n_major, n_minor
+        layout: (indptr, indices, data) sorted compressed layout, as from _compress
+        major, minor, values: new entries, sorted by (major, minor) without repeats
+        n_major, n_minor: number of rows and columns, which may have grown
+    :returns
+    (indptr, indices, data) with the new entries inserted in place and replacing the value
+    of an existing (major, minor) pair. the existing entries are found with a binary search
+    on their sorted (row, column) keys, so only the arrays are copied, nothing is re-sorted
+    """
+    indptr, indices, data = layout
+    indptr = np.concatenate((indptr, np.repeat(indptr[-1], n_major + 1 - len(indptr))))
+    rows = np.repeat(np.arange(n_major, dtype=np.int64), np.diff(indptr))
+    keys = rows * n_minor + indices
+    new_keys = major.astype(np.int64) * n_minor + minor
+    pos = np.searchsorted(keys, new_keys)
+    found = pos < len(keys)
+    found[found] = keys[pos[found]] == new_keys[found]
+    insert = pos[~found]
+    indices = np.insert(np.asarray(indices, dtype=np.int32), insert, minor[~found])
+    data = np.insert(np.asarray(data, dtype=np.float64), insert, values[~found])
+    # an existing entry moves back by the number of entries inserted before it
+    replace = pos[found]
+    data[replace + np.searchsorted(insert, replace, side='right')] = values[found]
+    indptr[1:] += np.cumsum(np.bincount(major[~found], minlength=n_major))
+    return (indptr, indices, data)
+
+
+@instrument.profiled()
 def file_reader(filepath):
     """
     :arg
@@ -13,20 +321,10 @@ def file_reader(filepath):
         userset: is a set of all users
         movieset: is a set of all movies
     """
-    csvdict = {}
-    userset = set()
-    movieset = set()
-    with open(filepath, 'r') as infile:
-        reader = csv.reader(infile)
-        for rows in reader:
-            if rows[0] not in userset:
-                csvdict[rows[0]] = {rows[1]:float(rows[2])}
-                userset.add(rows[0])
-            else:
-                csvdict[rows[0]][rows[1]] = float(rows[2])
-            movieset.add(rows[1])
-    return (csvdict, userset, movieset)
+    store = RatingsStore.from_csv(filepath)
+    return (store.fulldict(), store.userset(), store.movieset())
 
+@instrument.profiled()
 def get_averages(filepath):
     """
     :arg
@@ -39,33 +337,7 @@ def get_averages(filepath):
         movieavg: is a dictionary of dict[movie] = average overall rating
         totalavg: is a float, for overall rating of user-movie ratings
     """
-    userratings = {}
-    movieratings = {}
-    totalratings = []
-    userset = set()
-    movieset = set()
-    with open(filepath, 'r') as infile:
-        reader = csv.reader(infile)
-        for rows in reader:
-            if rows[0] not in userset:
-                userratings[rows[0]] = [float(rows[2])]
-                userset.add(rows[0])
-            else:
-                userratings[rows[0]].append(float(rows[2]))
-            if rows[1] not in movieset:
-                movieratings[rows[1]] = [float(rows[2])]
-                movieset.add(rows[1])
-            else:
-                movieratings[rows[1]].append(float(rows[2]))
-            totalratings.append(float(rows[2]))
-    useravg = {}
-    for user in userset:
-        useravg[user] = np.mean(userratings[user])
-    movieavg = {}
-    for movie in movieset:
-        movieavg[movie] = np.mean(movieratings[movie])
-    totalavg = np.mean(totalratings)
-    return (useravg, movieavg, totalavg)
+    return RatingsStore.from_csv(filepath).averages()
 
 def user_seen_sets(filepath):
     """
@@ -77,18 +349,7 @@ def user_seen_sets(filepath):
     usr_mv_sets in a dictionary
         usr_mv_set: is dict[user] = set of movies seen for that user
     """
-    usr_mv_sets = {}
-    userset = set()
-    with open(filepath, 'r') as infile:
-        reader = csv.reader(infile)
-        for rows in reader:
-            if rows[0] not in userset:
-                usr_mv_sets[rows[0]] = set()
-                usr_mv_sets[rows[0]].add(rows[1])
-                userset.add(rows[0])
-            else:
-                usr_mv_sets[rows[0]].add(rows[1])
-    return usr_mv_sets
+    return RatingsStore.from_csv(filepath).user_seen_sets()
 
 def films_user_sets(filepath):
     """
@@ -100,19 +361,9 @@ def films_user_sets(filepath):
     movie_to_user in a dictionary
         movie_to_user: is dict[movie] = set of users that have seen a movie per movie
     """
-    movie_to_user = {}
-    movieset = set()
-    with open(filepath, 'r') as infile:
-        reader = csv.reader(infile)
-        for rows in reader:
-            if rows[1] not in movieset:
-                movie_to_user[rows[1]] = set()
-                movie_to_user[rows[1]].add(rows[0])
-                movieset.add(rows[1])
-            else:
-                movie_to_user[rows[1]].add(rows[0])
-    return movie_to_user
+    return RatingsStore.from_csv(filepath).films_user_sets()
 
+@instrument.profiled()
 def get_distance(user1, user2, usr_sets, usr_avgs, fulldict):
     """
     :arg
@@ -147,36 +398,719 @@ def get_distance(user1, user2, usr_sets, usr_avgs, fulldict):
         distance = 0.0
     return distance
 
-def train_data(filepath):
+KINDS = ('user', 'adjusted_cosine', 'item_pearson')
+
+def similarity_matrices(store, kind='user'):
+    """
+    :arg
+    store, kind
+        store: a RatingsStore
+        kind: which similarity the rows of X are compared with
+            'user': pearson between users, ratings centered on the user's average
+            'adjusted_cosine': between movies, ratings centered on the user's average
+            'item_pearson': pearson between movies, ratings centered on the movie's average
+    :returns
+    (X, XT, XsqT, BT) scipy csr matrices used by similarity_block
+        X: user x movie centered ratings for 'user', movie x user for the item kinds
+        XT: X transposed, built straight from the store's other layout
+        XsqT: XT with every entry squared
+        BT: XT with every entry replaced by 1, marks who rated what
+    centered ratings of exactly 0 are kept as explicit entries so BT still marks them
+    """
+    if kind not in KINDS:
+        raise ValueError('kind must be one of %s, not %r' % (', '.join(KINDS), kind))
+    rows, cols = _layouts(store, kind)
+    row_ids = np.repeat(np.arange(len(rows[0]) - 1), np.diff(rows[0]))
+    col_ids = np.repeat(np.arange(len(cols[0]) - 1), np.diff(cols[0]))
+    if kind == 'user':
+        values = rows[2] - store.user_avgs[row_ids]
+        t_values = cols[2] - store.user_avgs[cols[1]]
+    elif kind == 'adjusted_cosine':
+        values = rows[2] - store.user_avgs[rows[1]]
+        t_values = cols[2] - store.user_avgs[col_ids]
+    else:
+        values = rows[2] - store.movie_avgs[row_ids]
+        t_values = cols[2] - store.movie_avgs[cols[1]]
+    shape = (len(rows[0]) - 1, len(cols[0]) - 1)
+    X = sparse.csr_matrix((values, rows[1], rows[0]), shape=shape)
+    XT = sparse.csr_matrix((t_values, cols[1], cols[0]), shape=shape[::-1])
+    XsqT = sparse.csr_matrix((t_values**2, cols[1], cols[0]), shape=shape[::-1])
+    BT = sparse.csr_matrix((np.ones(len(t_values)), cols[1], cols[0]), shape=shape[::-1])
+    return (X, XT, XsqT, BT)
+
+def _layouts(store, kind):
+    """
+    (rows, cols): the store's (indptr, indices, data) layouts with the rows of the given
+    similarity kind first, CSR then CSC for 'user', CSC then CSR for the item kinds
+    """
+    csr = (store.indptr, store.indices, store.data)
+    csc = (store.col_indptr, store.col_indices, store.col_data)
+    if kind == 'user':
+        return (csr, csc)
+    return (csc, csr)
+
+def _ranges(indptr, ids):
+    """
+    (owner, positions): positions lists every entry of the slices indptr[i]:indptr[i+1] for
+    each i in ids one after the other, owner gives the index into ids each one came from
+    """
+    starts = indptr[ids]
+    lengths = indptr[ids + 1] - starts
+    owner = np.repeat(np.arange(len(ids)), lengths)
+    offsets = np.cumsum(lengths) - lengths
+    return (owner, np.arange(lengths.sum()) - np.repeat(offsets - starts, lengths))
+
+def _take_rows(X, rows):
+    """
+    the rows (slice or integer array) of csr matrix X as a csr matrix, gathered straight
+    from X's arrays so explicit zeros are kept, scipy's X[int_array] drops them
+    """
+    ids = np.arange(X.shape[0])[rows]
+    indptr = np.zeros(len(ids) + 1, dtype=np.int64)
+    np.cumsum(X.indptr[ids + 1] - X.indptr[ids], out=indptr[1:])
+    gather = _ranges(X.indptr, ids)[1]
+    return sparse.csr_matrix((X.data[gather], X.indices[gather], indptr),
+                             shape=(len(ids), X.shape[1]))
+
+def similarity_block(matrices, start, stop):
+    """
+    :arg
+    matrices, start, stop
+        matrices: tuple from similarity_matrices
+        start, stop: the block of user ids [start, stop) to compute rows for
+    :returns
+    sims
+        sims: scipy csr matrix of shape (stop - start, number of users), sims[i, j] is the
+        pearson coefficient between user start + i and user j, the same number get_distance
+        gives. only pairs with a nonzero coefficient are stored and the diagonal is dropped
+    """
+    return similarity_rows(matrices, slice(start, stop))
+
+def similarity_rows(matrices, rows):
+    """
+    :arg
+    matrices, rows
+        matrices: tuple from similarity_matrices
+        rows: slice or integer array of the user ids to compute rows for
+    :returns
+    scipy csr matrix with one row of similarities per user in rows, see similarity_block
+    """
+    X, XT, XsqT, BT = matrices
+    block = _take_rows(X, rows)
+    block_sq = sparse.csr_matrix((block.data**2, block.indices, block.indptr), shape=block.shape)
+    block_b = sparse.csr_matrix((np.ones(len(block.data)), block.indices, block.indptr),
+                                shape=block.shape)
+    # over the movies both users rated: top is sum(diff1 * diff2), bottom is
+    # sum(diff1**2) * sum(diff2**2)
+    top = block.dot(XT)
+    bottom = block_sq.dot(BT).multiply(block_b.dot(XsqT)).tocsr()
+    bottom.data = 1.0 / np.sqrt(bottom.data)
+    sims = top.multiply(bottom).tocsr()
+    row_ids = np.repeat(np.arange(X.shape[0])[rows], np.diff(sims.indptr))
+    sims.data[row_ids == sims.indices] = 0.0
+    sims.eliminate_zeros()
+    return sims
+
+def similarity_blocks(store, block_size=512, workers=1):
+    """
+    :arg
+    store, block_size, workers
+        store: a RatingsStore
+        block_size: number of users per block, bounds the memory of each sparse product
+        workers: number of processes computing blocks, see map_blocks
+    :returns
+    generator of (start, stop, sims) for consecutive blocks of users, see similarity_block
+    """
+    n_users = len(store.users)
+    blocks = map_blocks(store, similarity_block, (), block_size, workers)
+    for i, sims in enumerate(blocks):
+        start = i * block_size
+        yield (start, min(start + block_size, n_users), sims)
+
+def map_blocks(store, func, args=(), block_size=512, workers=1, kind='user'):
+    """
+    :arg
+    store, func, args, block_size, workers, kind
+        store: a RatingsStore
+        func: module level function called as func(matrices, start, stop, *args)
+        args: extra arguments for func
+        block_size: number of users per block
+        workers: number of processes, with more than one the similarity matrices are
+            written once to a temporary directory and every worker memory-maps them read-only
+        kind: similarity kind, see similarity_matrices. the item kinds make blocks of movies
+    :returns
+    generator of func's result for each block of users, in block order. blocks do not
+    depend on the number of workers, so neither does the result
+    """
+    matrices = similarity_matrices(store, kind)
+    n_rows = matrices[0].shape[0]
+    tasks = [(func, start, min(start + block_size, n_rows), args)
+             for start in range(0, n_rows, block_size)]
+    if workers <= 1 or len(tasks) <= 1:
+        for func, start, stop, args in tasks:
+            yield func(matrices, start, stop, *args)
+        return
+    directory = tempfile.mkdtemp(prefix='cf_blocks_')
+    try:
+        _dump_matrices(matrices, directory)
+        del matrices
+        pool = multiprocessing.Pool(workers, _init_block_worker, (directory,))
+        try:
+            for result in pool.imap(_run_block, tasks):
+                yield result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+_MATRIX_NAMES = ('X', 'XT', 'XsqT', 'BT')
+_block_matrices = None
+
+def _dump_matrices(matrices, directory):
+    """writes the arrays of the similarity_matrices tuple as .npy files in directory"""
+    for name, matrix in zip(_MATRIX_NAMES, matrices):
+        np.save(os.path.join(directory, name + '_data.npy'), matrix.data)
+        np.save(os.path.join(directory, name + '_indices.npy'), matrix.indices)
+        np.save(os.path.join(directory, name + '_indptr.npy'), matrix.indptr)
+        np.save(os.path.join(directory, name + '_shape.npy'), np.array(matrix.shape))
+
+def _load_matrices(directory):
+    """memory-maps the similarity_matrices tuple written by _dump_matrices"""
+    matrices = []
+    for name in _MATRIX_NAMES:
+        arrays = [np.load(os.path.join(directory, name + part + '.npy'), mmap_mode='r')
+                  for part in ('_data', '_indices', '_indptr')]
+        shape = tuple(np.load(os.path.join(directory, name + '_shape.npy')))
+        matrices.append(sparse.csr_matrix(tuple(arrays), shape=shape, copy=False))
+    return tuple(matrices)
+
+def _init_block_worker(directory):
+    global _block_matrices
+    _block_matrices = _load_matrices(directory)
+
+def _run_block(task):
+    func, start, stop, args = task
+    return func(_block_matrices, start, stop, *args)
+
+class NeighborModel(object):
+    """
+    a model that keeps only the most similar neighbors of each user (or of each movie, for
+    the item kinds), in compact parallel arrays instead of a dict of every pair
+    attributes:
+        store: the RatingsStore the model was trained on
+        kind: the similarity kind, see similarity_matrices
+        indptr: int64 array, the neighbors of user (movie) id u are at indptr[u]:indptr[u+1]
+        neighbors: int32 array of neighbor user (movie) ids, most similar first
+        weights: float32 array of the similarity for each neighbor
+        params: dict of the k, min_similarity, min_common and kind the model was trained with
+    """
+
+    def __init__(self, store, indptr, neighbors, weights, params=None):
+        self.store = store
+        self.indptr = indptr
+        self.neighbors = neighbors
+        self.weights = weights
+        self.params = params or {'k': None, 'min_similarity': None, 'min_common': None}
+        self.kind = self.params.get('kind', 'user')
+
+    @instrument.profiled('NeighborModel.update')
+    def update(self, new_ratings, block_size=512):
+        """
+        :arg
+        new_ratings, block_size
+            new_ratings: iterable of (user, movie, rating) rows, like the rows of the training csv
+            block_size: number of rows whose similarities are recomputed at a time
+        :returns
+        integer array of the user (movie) ids whose neighbors were recomputed or patched
+        adds the ratings to the store, refreshing the sums and averages they touch. only the
+        rows whose centered ratings changed have similarities that moved: those rows are
+        recomputed, and since similarities are symmetric they also hold every new (row,
+        changed row) similarity of the other rows. each other row that had or now gets a
+        changed row as a candidate is patched in place with those, and only recomputed when
+        the patch could let in a neighbor its stored top k doesn't know about (see
+        _patch_row). the model ends up the same as one retrained on the old and new rows
+        """
+        store = self.store
+        touched_users, touched_movies = store.add_ratings(new_ratings)
+        rows = _layouts(store, self.kind)[0]
+        if self.kind == 'user':
+            changed = touched_users
+        elif self.kind == 'adjusted_cosine':
+            # a new user average moves every rating of that user
+            changed = np.unique(store.indices[_ranges(store.indptr, touched_users)[1]])
+        else:
+            changed = touched_movies
+        changed = changed.astype(np.int64)
+        n_rows = len(rows[0]) - 1
+        k = self.params['k']
+        min_similarity = self.params['min_similarity']
+        min_common = self.params['min_common']
+        matrices = similarity_matrices(store, self.kind)
+        indptr = np.concatenate((self.indptr, np.repeat(self.indptr[-1], n_rows + 1 - len(self.indptr))))
+        neighbors = np.asarray(self.neighbors)
+        weights = np.asarray(self.weights)
+        is_changed = np.zeros(n_rows, dtype=bool)
+        is_changed[changed] = True
+        lists = {}
+        patch_rows = []
+        patch_ids = []
+        patch_sims = []
+        for start in range(0, len(changed), block_size):
+            block_rows = changed[start:start + block_size]
+            sims = candidate_rows(matrices, block_rows, min_similarity, min_common)
+            counts, block_neighbors, block_weights = top_neighbors(sims, k)
+            ends = np.cumsum(counts)
+            for row, end, count in zip(block_rows, ends, counts):
+                lists[row] = (block_neighbors[end - count:end], block_weights[end - count:end])
+            owner = np.repeat(block_rows, np.diff(sims.indptr))
+            other = ~is_changed[sims.indices]
+            patch_rows.append(sims.indices[other])
+            patch_ids.append(owner[other])
+            patch_sims.append(sims.data[other])
+        patch_rows = np.concatenate(patch_rows) if patch_rows else np.zeros(0, np.int64)
+        patch_ids = np.concatenate(patch_ids) if patch_ids else np.zeros(0, np.int64)
+        patch_sims = np.concatenate(patch_sims) if patch_sims else np.zeros(0)
+        # rows that stored a changed neighbor lose it, whether or not it comes back
+        owners = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+        losing = owners[is_changed[neighbors] & ~is_changed[owners]]
+        patched = np.unique(np.concatenate((patch_rows, losing))).astype(np.int64)
+        order = np.argsort(patch_rows, kind='mergesort')
+        patch_rows, patch_ids, patch_sims = patch_rows[order], patch_ids[order], patch_sims[order]
+        bounds = np.searchsorted(patch_rows, patched)
+        bounds = np.append(bounds, len(patch_rows))
+        stale = []
+        for i, row in enumerate(patched):
+            new = slice(bounds[i], bounds[i + 1])
+            patch = _patch_row(neighbors[indptr[row]:indptr[row + 1]],
+                               weights[indptr[row]:indptr[row + 1]], is_changed,
+                               patch_ids[new], patch_sims[new], k)
+            if patch is None:
+                stale.append(row)
+            else:
+                lists[row] = patch
+        stale = np.array(stale, dtype=np.int64)
+        for start in range(0, len(stale), block_size):
+            block_rows = stale[start:start + block_size]
+            counts, block_neighbors, block_weights = neighbor_rows(matrices, block_rows, k,
+                                                                   min_similarity, min_common)
+            ends = np.cumsum(counts)
+            for row, end, count in zip(block_rows, ends, counts):
+                lists[row] = (block_neighbors[end - count:end], block_weights[end - count:end])
+        rewritten = np.zeros(n_rows, dtype=bool)
+        rewritten[list(lists)] = True
+        kept = ~rewritten[owners]
+        counts = np.diff(indptr)
+        owners = [owners[kept]]
+        new_neighbors = [neighbors[kept]]
+        new_weights = [weights[kept]]
+        for row in sorted(lists):
+            counts[row] = len(lists[row][0])
+            owners.append(np.repeat(row, counts[row]))
+            new_neighbors.append(lists[row][0])
+            new_weights.append(lists[row][1])
+        order = np.argsort(np.concatenate(owners), kind='mergesort')
+        self.indptr = np.zeros(n_rows + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.indptr[1:])
+        self.neighbors = np.concatenate(new_neighbors)[order].astype(np.int32)
+        self.weights = np.concatenate(new_weights)[order].astype(np.float32)
+        return np.array(sorted(lists), dtype=np.int64)
+
+    def neighbors_of(self, name):
+        """
+        :arg
+        name: string of user, or of movie for the item kinds
+        :returns
+        dict of neighbor string -> similarity
+        """
+        if self.kind == 'user':
+            ids, names = self.store.user_ids, self.store.users
+        else:
+            ids, names = self.store.movie_ids, self.store.movies
+        row = slice(self.indptr[ids[name]], self.indptr[ids[name] + 1])
+        return dict((names[v], w) for v, w in zip(self.neighbors[row], self.weights[row].tolist()))
+
+    def predict(self, user, movie):
+        """
+        :arg
+        user, movie
+            user: string of user, must be in the training set
+            movie: string of movie, must be in the training set
+        :return
+        (prediction, user, movie), like predict but only scanning the stored neighbors
+        """
+        uid = np.array([self.store.user_ids[user]])
+        mid = np.array([self.store.movie_ids[movie]])
+        return (self.predict_ids(uid, mid)[0], user, movie)
+
+    @instrument.profiled('NeighborModel.predict_batch',
+                         items=lambda result: len(result[0] if isinstance(result, tuple) else result))
+    def predict_batch(self, pairs, return_categories=False):
+        """
+        :arg
+        pairs, return_categories
+            pairs: iterable of (user, movie) string pairs, extra items in each pair are ignored
+            return_categories: also return the check_membership result of every pair
+        :returns
+        numpy array of predictions in the order of pairs. pairs with an unknown user or movie
+        fall back like test_data does with check_membership: the user's average, the movie's
+        average, or the average of every training rating. with return_categories the
+        result is (predictions, categories), categories an int array of 1 to 4
+        """
+        store = self.store
+        uids = []
+        mids = []
+        for pair in pairs:
+            uids.append(store.user_ids.get(pair[0], -1))
+            mids.append(store.movie_ids.get(pair[1], -1))
+        uids = np.array(uids, dtype=np.int64)
+        mids = np.array(mids, dtype=np.int64)
+        known_user = uids >= 0
+        known_movie = mids >= 0
+        predictions = np.empty(len(uids))
+        predictions.fill(store.total_avg)
+        just_user = known_user & ~known_movie
+        predictions[just_user] = store.user_avgs[uids[just_user]]
+        just_movie = known_movie & ~known_user
+        predictions[just_movie] = store.movie_avgs[mids[just_movie]]
+        both = known_user & known_movie
+        predictions[both] = self.predict_ids(uids[both], mids[both])
+        if return_categories:
+            categories = np.select([both, just_user, just_movie], [1, 2, 3], 4)
+            return (predictions, categories)
+        return predictions
+
+    def predict_ids(self, uids, mids):
+        """
+        :arg
+        uids, mids: integer arrays of user and movie ids that are both in the training set
+        :returns
+        numpy array of predictions, the base average plus the similarity weighted mean of
+        the neighbors' deviations:
+            'user': user average + deviations of the neighbor users' ratings of the movie
+                from their own averages
+            'adjusted_cosine': user average + deviations of the user's ratings of the
+                neighbor movies from the user's average
+            'item_pearson': movie average + deviations of the user's ratings of the
+                neighbor movies from those movies' averages
+        requests are grouped by the movie ('user') or the user (item kinds), each group
+        gathers the neighbor lists of its requests and looks them up at once in the
+        group's sorted list of raters (rated movies)
+        """
+        store = self.store
+        if self.kind == 'user':
+            owners, groups = uids, mids
+            lists = (store.col_indptr, store.col_indices, store.col_data)
+        else:
+            owners, groups = mids, uids
+            lists = (store.indptr, store.indices, store.data)
+        # copied, the averages of a loaded model are a read-only memmap
+        if self.kind == 'item_pearson':
+            predictions = np.array(store.movie_avgs[mids], dtype=np.float64)
+        else:
+            predictions = np.array(store.user_avgs[uids], dtype=np.float64)
+        order = np.argsort(groups, kind='mergesort')
+        bounds = np.flatnonzero(np.diff(groups[order])) + 1
+        for group in np.split(order, bounds):
+            if not len(group):
+                continue
+            gid = groups[group[0]]
+            ids = lists[1][lists[0][gid]:lists[0][gid + 1]]
+            jdiffs = lists[2][lists[0][gid]:lists[0][gid + 1]]
+            if self.kind == 'user':
+                jdiffs = jdiffs - store.user_avgs[ids]
+            elif self.kind == 'adjusted_cosine':
+                jdiffs = jdiffs - store.user_avgs[gid]
+            else:
+                jdiffs = jdiffs - store.movie_avgs[ids]
+            owner, gather = _ranges(self.indptr, owners[group])
+            neighbors = self.neighbors[gather]
+            weights = self.weights[gather].astype(np.float64)
+            pos = np.minimum(np.searchsorted(ids, neighbors), max(len(ids) - 1, 0))
+            if len(ids):
+                seen = ids[pos] == neighbors
+            else:
+                seen = np.zeros(len(neighbors), dtype=bool)
+            rightsum = np.bincount(owner[seen], weights=weights[seen] * jdiffs[pos[seen]],
+                                   minlength=len(group))
+            coeff = np.bincount(owner[seen], weights=np.abs(weights[seen]), minlength=len(group))
+            right = np.zeros(len(group))
+            np.divide(rightsum, coeff, out=right, where=coeff != 0)
+            predictions[group] += right
+        return predictions
+
+
+def top_neighbors(sims, k=None, min_similarity=None):
     """
     :arg
-    path to csv file, should be in the form:
-        user, movie, rating
+    sims, k, min_similarity
+        sims: scipy csr matrix of similarities, one row per user
+        k: how many neighbors to keep per row, None keeps all of them
+        min_similarity: drop neighbors with a smaller similarity, None keeps all of them
+    :returns
+    (counts, neighbors, weights)
+        counts: number of neighbors kept per row
+        neighbors: int32 array of the kept column ids, row by row, most similar first
+            by the float32 weight that is stored (ties go to the lower user id so the result
+            does not depend on the input order, and a row's order follows from its weights)
+        weights: float32 array of the kept similarities
+    """
+    counts = np.zeros(sims.shape[0], dtype=np.int64)
+    neighbors = []
+    weights = []
+    for i in range(sims.shape[0]):
+        ids = sims.indices[sims.indptr[i]:sims.indptr[i + 1]]
+        vals = sims.data[sims.indptr[i]:sims.indptr[i + 1]]
+        if min_similarity is not None:
+            keep = vals >= min_similarity
+            ids, vals = ids[keep], vals[keep]
+        order = np.lexsort((ids, -vals.astype(np.float32)))[:k]
+        counts[i] = len(order)
+        neighbors.append(ids[order])
+        weights.append(vals[order])
+    neighbors = np.concatenate(neighbors).astype(np.int32) if neighbors else np.zeros(0, np.int32)
+    weights = np.concatenate(weights).astype(np.float32) if weights else np.zeros(0, np.float32)
+    return (counts, neighbors, weights)
+
+def overlap_rows(matrices, rows):
+    """
+    :arg
+    matrices, rows: as in similarity_rows
+    :returns
+    scipy csr matrix with one row per user in rows, holding the number of movies that user
+    and user j have both rated
+    """
+    X, XT, XsqT, BT = matrices
+    block = _take_rows(X, rows)
+    block_b = sparse.csr_matrix((np.ones(len(block.data)), block.indices, block.indptr),
+                                shape=block.shape)
+    return block_b.dot(BT).tocsr()
+
+def neighbor_block(matrices, start, stop, k=None, min_similarity=None, min_common=None):
+    """
+    :arg
+    matrices, start, stop: as in similarity_block
+    k, min_similarity, min_common: as in train_neighbors
+    :returns
+    top_neighbors of the similarity rows of users [start, stop)
+    """
+    return neighbor_rows(matrices, slice(start, stop), k, min_similarity, min_common)
+
+def neighbor_rows(matrices, rows, k=None, min_similarity=None, min_common=None):
+    """
+    :arg
+    matrices, rows: as in similarity_rows
+    k, min_similarity, min_common: as in train_neighbors
+    :returns
+    top_neighbors of the similarity rows of the users in rows
+    """
+    return top_neighbors(candidate_rows(matrices, rows, min_similarity, min_common), k)
+
+def candidate_rows(matrices, rows, min_similarity=None, min_common=None):
+    """
+    :arg
+    matrices, rows: as in similarity_rows
+    min_similarity, min_common: as in train_neighbors
+    :returns
+    the similarity rows of the users in rows, keeping only the pairs that pass
+    min_similarity and min_common, every one a candidate neighbor
+    """
+    sims = similarity_rows(matrices, rows)
+    if min_common is not None:
+        sims = sims.multiply(overlap_rows(matrices, rows) >= min_common).tocsr()
+    if min_similarity is not None:
+        sims.data[sims.data < min_similarity] = 0.0
+        sims.eliminate_zeros()
+    return sims
+
+def _patch_row(neighbors, weights, is_changed, new_ids, new_sims, k=None):
+    """
+    :arg
+    neighbors, weights, is_changed, new_ids, new_sims, k
+        neighbors, weights: a row's stored neighbors and float32 weights, as from top_neighbors
+        is_changed: bool array marking the rows whose similarities changed
+        new_ids, new_sims: the row's candidates among the changed rows, with their similarities
+        k: as in train_neighbors
+    :returns
+    (neighbors, weights) of the row with its changed neighbors replaced by new_ids, or None
+    when that can't be told without recomputing the row
+    a row that was full (k neighbors) may have had candidates cut, which all rank after its
+    last neighbor, so the patch only holds if its k slots are still filled by neighbors
+    ranked up to that one
+    """
+    keep = ~is_changed[neighbors]
+    ids = np.concatenate((neighbors[keep], new_ids)).astype(np.int32)
+    values = np.concatenate((weights[keep], new_sims.astype(np.float32)))
+    order = np.lexsort((ids, -values))[:k]
+    if k is not None and len(neighbors) == k:
+        if len(order) < k:
+            return None
+        last = order[-1]
+        if (-values[last], ids[last]) > (-weights[-1], neighbors[-1]):
+            return None
+    return (ids[order], values[order])
+
+@instrument.profiled(items=lambda model: len(model.indptr) - 1)
+def train_neighbors(store, k=None, min_similarity=None, min_common=None, block_size=512, workers=1,
+                    kind='user'):
+    """
+    :arg
+    store, k, min_similarity, min_common, block_size, workers, kind
+        store: a RatingsStore of the training data
+        k: number of most similar neighbors to keep per user (movie), None keeps every nonzero one
+        min_similarity: only keep neighbors with at least this similarity
+        min_common: only keep neighbors with at least this many co-rated movies (co-raters)
+        block_size: number of users (movies) per block of similarity_blocks
+        workers: number of processes computing blocks, see map_blocks
+        kind: 'user' for user-user neighbors, 'adjusted_cosine' or 'item_pearson' for
+            movie-movie neighbors, see similarity_matrices
+    :returns
+    a NeighborModel, only one block of similarities per worker is ever held in memory
+    """
+    if k is not None and k < 1:
+        raise ValueError('k must be at least 1 or None, not %r' % k)
+    n_rows = len(store.users) if kind == 'user' else len(store.movies)
+    counts = []
+    neighbors = []
+    weights = []
+    args = (k, min_similarity, min_common)
+    for block in map_blocks(store, neighbor_block, args, block_size, workers, kind):
+        counts.append(block[0])
+        neighbors.append(block[1])
+        weights.append(block[2])
+    indptr = np.zeros(n_rows + 1, dtype=np.int64)
+    if counts:
+        np.cumsum(np.concatenate(counts), out=indptr[1:])
+    neighbors = np.concatenate(neighbors) if neighbors else np.zeros(0, np.int32)
+    weights = np.concatenate(weights) if weights else np.zeros(0, np.float32)
+    params = {'k': k, 'min_similarity': min_similarity, 'min_common': min_common, 'kind': kind}
+    return NeighborModel(store, indptr, neighbors, weights, params)
+
+@instrument.profiled(items=lambda result: len(result[1]))
+def train_data(filepath, block_size=512, k=None, min_similarity=None, min_common=None, workers=1,
+               kind='user'):
+    """
+    :arg
+    filepath, block_size, k, min_similarity, min_common, workers, kind
+        filepath: path to csv file, should be in the form:
+            user, movie, rating
+        block_size: number of users per block of similarity_blocks
+        workers: number of processes computing similarity blocks
+        k, min_similarity, min_common: if any is given, train a top-k NeighborModel
+            instead of the full model, see train_neighbors
+        kind: 'user', or one of the item kinds 'adjusted_cosine' and 'item_pearson',
+            which always train a NeighborModel of movie neighborhoods
     :returns
     (model, userset, movieset)
-        model: is a dict of dicts of form dict[user] = {other user:similarity}
+        model: is a dict of dicts of form dict[user] = {other user:similarity}, or a
+            NeighborModel if k, min_similarity or min_common is given or kind isn't 'user'
         userset: set of all users in training set
         movieset: set of all movies in training set
     """
     model = {}
-    fulldict, userset, movieset = file_reader(filepath)
-    useravg, movieavg, totalavg = get_averages(filepath)
-    userseen_sets = user_seen_sets(filepath)
-    for user in userset:
-        model[user] = {}
-        compareset = set(userset)
-        compareset.remove(user)
-        for otheruser in compareset:
-            model[user][otheruser] = get_distance(user, otheruser, userseen_sets, useravg, fulldict)
+    store = RatingsStore.from_csv(filepath)
+    userset, movieset = store.userset(), store.movieset()
+    if k is not None or min_similarity is not None or min_common is not None or kind != 'user':
+        model = train_neighbors(store, k, min_similarity, min_common, block_size, workers, kind)
+        return (model, userset, movieset)
+    users = store.users
+    for start, stop, sims in similarity_blocks(store, block_size, workers):
+        for i in range(stop - start):
+            user = users[start + i]
+            model[user] = dict.fromkeys(userset, 0.0)
+            del model[user][user]
+            row = slice(sims.indptr[i], sims.indptr[i + 1])
+            for otheruser, distance in zip(sims.indices[row], sims.data[row].tolist()):
+                model[user][users[otheruser]] = distance
     return (model, userset, movieset)
 
+MODEL_VERSION = 1
+_MODEL_MAGIC = b'CFMODEL\x00'
+_MODEL_ALIGN = 64
+
+@instrument.profiled()
+def save_model(model, filepath):
+    """
+    :arg
+    model, filepath
+        model: a NeighborModel
+        filepath: where to write it
+    writes the model in cf.py's binary model format, version MODEL_VERSION:
+        8 byte magic, uint32 version, uint32 header length, a json header holding the
+        id maps, the global sums, the training params and a table of arrays, then every
+        array as raw bytes starting on a 64 byte boundary so load_model can memory-map it
+        in place
+    """
+    if not isinstance(model, NeighborModel):
+        raise TypeError('save_model needs a NeighborModel, train one with train_neighbors')
+    store = model.store
+    arrays = [(name, getattr(store, name)) for name in STORE_ARRAYS + ('user_avgs', 'movie_avgs')]
+    arrays += [('model_indptr', model.indptr), ('model_neighbors', model.neighbors),
+               ('model_weights', model.weights)]
+    table = {}
+    offset = 0
+    for name, values in arrays:
+        values = np.asarray(values)
+        table[name] = {'dtype': values.dtype.str, 'shape': list(values.shape), 'offset': offset}
+        offset += -(-values.nbytes // _MODEL_ALIGN) * _MODEL_ALIGN
+    header = json.dumps({'users': list(store.users), 'movies': list(store.movies),
+                         'total_sum': store.total_sum, 'total_count': store.total_count,
+                         'params': model.params, 'arrays': table}).encode('utf-8')
+    start = _data_start(len(header))
+    with open(filepath, 'wb') as outfile:
+        outfile.write(_MODEL_MAGIC + struct.pack('<II', MODEL_VERSION, len(header)) + header)
+        for name, values in arrays:
+            outfile.seek(start + table[name]['offset'])
+            outfile.write(np.ascontiguousarray(values).tobytes())
+        outfile.truncate(start + offset)
+
+@instrument.profiled()
+def load_model(filepath):
+    """
+    :arg
+    filepath: a file written by save_model
+    :returns
+    the NeighborModel, its arrays are read-only memory maps of the file so loading does no
+    array copies and processes scoring with the same file share its pages
+    """
+    with open(filepath, 'rb') as infile:
+        magic = infile.read(len(_MODEL_MAGIC))
+        if magic != _MODEL_MAGIC:
+            raise ValueError('%s is not a cf.py model file' % filepath)
+        version, header_len = struct.unpack('<II', infile.read(8))
+        if version != MODEL_VERSION:
+            raise ValueError('%s has model format version %d, expected %d'
+                             % (filepath, version, MODEL_VERSION))
+        header = json.loads(infile.read(header_len).decode('utf-8'))
+    start = _data_start(header_len)
+    arrays = {}
+    for name, info in header['arrays'].items():
+        shape = tuple(info['shape'])
+        if np.prod(shape) == 0:
+            arrays[name] = np.zeros(shape, dtype=info['dtype'])
+        else:
+            arrays[name] = np.memmap(filepath, dtype=info['dtype'], mode='r',
+                                     offset=start + info['offset'], shape=shape)
+    store = RatingsStore.from_arrays(header['users'], header['movies'], arrays,
+                                     header['total_sum'], header['total_count'])
+    return NeighborModel(store, arrays['model_indptr'], arrays['model_neighbors'],
+                         arrays['model_weights'], header.get('params'))
+
+def _data_start(header_len):
+    """offset of the first array in a model file with a header of header_len bytes"""
+    end = len(_MODEL_MAGIC) + 8 + header_len
+    return -(-end // _MODEL_ALIGN) * _MODEL_ALIGN
+
+@instrument.profiled()
 def predict(user, movie, model, fulldata, useravg, film_user_set):
     """
     :param
     user, movie, model, fullset,useravg, film_user_set:
         user: string of user
         movie: string of movie
-        model: dict of dict of pearson coeff per user between every other user
+        model: dict of dict of pearson coeff per user between every other user, or a
+            NeighborModel, which predicts from its own arrays and ignores the other arguments
         fulldata: the original training data in dict[user][film]=rating
         useravg: dictionary of average ratings per user
         film_user_set: dictionary of dict[film]={set of all users who saw this film}
@@ -186,13 +1120,12 @@ def predict(user, movie, model, fulldata, useravg, film_user_set):
         user: user
         movie: movie
     """
-    compare_set = film_user_set[movie]
-    if user in compare_set:
-        compare_set.remove(user)
+    if isinstance(model, NeighborModel):
+        return model.predict(user, movie)
     rightsum = 0
     coeff = 0
-    for compare_user in compare_set:
-        if model[user][compare_user]:
+    for compare_user in film_user_set[movie]:
+        if compare_user != user and model[user][compare_user]:
             jdiff = fulldata[compare_user][movie] - useravg[compare_user]
             rightsum += model[user][compare_user] * jdiff
             coeff += abs(model[user][compare_user])
@@ -236,12 +1169,18 @@ def check_membership(user, movie, userset, movieset):
         result = 4 # neither
     return result
 
+@instrument.profiled(items=len)
 def test_data(model, filepath, filepath_testing):
-    fulldata, userset, movieset = file_reader(filepath)
-    useravg, movieavg, totalavg = get_averages(filepath)
-    film_user_set = films_user_sets(filepath)
-    result_list = []
     pred_list = predict_list(filepath_testing)
+    if isinstance(model, NeighborModel):
+        predictions = model.predict_batch(pred_list).tolist()
+        return [(row[0], row[1], float(row[2]), prediction)
+                for row, prediction in zip(pred_list, predictions)]
+    store = RatingsStore.from_csv(filepath)
+    fulldata, userset, movieset = store.fulldict(), store.userset(), store.movieset()
+    useravg, movieavg, totalavg = store.averages()
+    film_user_set = store.films_user_sets()
+    result_list = []
     for row in pred_list:
         row_id = (row[0],row[1], float(row[2]))
         row_type = check_membership(row[0], row[1], userset, movieset)
@@ -276,16 +1215,92 @@ def makefile(prediction_list):
         writer = csv.writer(csvfile)
         writer.writerows(prediction_list)
 
+CATEGORIES = ('both', 'user_only', 'movie_only', 'neither')
+
+@instrument.profiled(items=lambda metrics: metrics['all']['count'])
+def evaluate_stream(model, filepath_testing, outfile='predictions.txt', chunksize=100000):
+    """
+    :arg
+    model, filepath_testing, outfile, chunksize
+        model: a NeighborModel
+        filepath_testing: path to the testing csv, rows of user,movie,rating
+        outfile: where to write the user,movie,rating,prediction rows, like makefile
+        chunksize: number of testing rows read, scored and written at a time
+    :returns
+    metrics: dict of 'all' and each of CATEGORIES (the check_membership results in order)
+        to a dict of 'count', 'MAE' and 'RMSE' over those rows, nan when there are none
+    only one chunk of rows is held at a time, the errors go into running sums
+    """
+    counts = np.zeros(5)
+    abs_sums = np.zeros(5)
+    sq_sums = np.zeros(5)
+    with open(filepath_testing, 'r') as infile:
+        with open(outfile, 'w') as csvfile:
+            reader = csv.reader(infile)
+            writer = csv.writer(csvfile)
+            while True:
+                rows = list(itertools.islice(reader, chunksize))
+                if not rows:
+                    break
+                predictions, categories = model.predict_batch(rows, return_categories=True)
+                actual = np.array([float(row[2]) for row in rows])
+                errors = predictions - actual
+                counts += np.bincount(categories, minlength=5)
+                abs_sums += np.bincount(categories, weights=np.abs(errors), minlength=5)
+                sq_sums += np.bincount(categories, weights=errors**2, minlength=5)
+                writer.writerows((row[0], row[1], rating, prediction) for row, rating, prediction
+                                 in zip(rows, actual.tolist(), predictions.tolist()))
+    counts[0], abs_sums[0], sq_sums[0] = counts[1:].sum(), abs_sums[1:].sum(), sq_sums[1:].sum()
+    metrics = {}
+    for i, name in enumerate(('all',) + CATEGORIES):
+        if counts[i]:
+            MAE = float(abs_sums[i] / counts[i])
+            RMSE = float(np.sqrt(sq_sums[i] / counts[i]))
+        else:
+            MAE = RMSE = float('nan')
+        metrics[name] = {'count': int(counts[i]), 'MAE': MAE, 'RMSE': RMSE}
+    return metrics
+
 
 if __name__== '__main__':
     parser = argparse.ArgumentParser(description='collaborate filtering algorithm')
-    parser.add_argument('-t','--train', help='your training data csv', required=True)
+    parser.add_argument('-t','--train', help='your training data csv')
     parser.add_argument('-T','--test', help='your testing data csv', required=True)
+    parser.add_argument('-k','--neighbors', type=int, help='only keep this many most similar users per user')
+    parser.add_argument('--min-similarity', type=float, help='only keep neighbors at least this similar')
+    parser.add_argument('--min-common', type=int, help='only keep neighbors with this many movies in common')
+    parser.add_argument('-w','--workers', type=int, default=1, help='processes used to compute similarities')
+    parser.add_argument('-s','--similarity', choices=KINDS, default='user',
+                        help='user-user pearson, or item-item adjusted cosine / pearson')
+    parser.add_argument('-m','--model', help='model file, loaded if it exists, otherwise trained and saved there')
+    parser.add_argument('--profile', nargs='?', const='-',
+                        help='record the time, calls, items and memory of each stage, logged to stderr '
+                             'or written as json to the given file')
     args = vars(parser.parse_args())
+    if args['neighbors'] is not None and args['neighbors'] < 1:
+        parser.error('-k must be at least 1')
+    if args['profile']:
+        instrument.enable_from_option(args['profile'])
     trainset =  args['train']
     testset =  args['test']
-    model = train_data(trainset)[0]
-    predicted = test_data(model, trainset, testset)
-    makefile(predicted)
-    print 'Mean Absolute Error is: ' + str(find_MAE(predicted))
-    print 'Root Mean Squared Error is: ' + str(find_MSRE(predicted))
+    modelfile = args['model']
+    if modelfile and os.path.exists(modelfile):
+        model = load_model(modelfile)
+    elif not trainset:
+        parser.error('--train is required unless --model names an existing model file')
+    else:
+        # without -k/--min-similarity/--min-common this keeps every neighbor,
+        # which predicts like train_data's dense model (up to the float32
+        # weights) but is evaluated by evaluate_stream, a chunk at a time
+        model = train_neighbors(RatingsStore.from_csv(trainset), args['neighbors'], args['min_similarity'],
+                                args['min_common'], workers=args['workers'], kind=args['similarity'])
+        if modelfile:
+            save_model(model, modelfile)
+    metrics = evaluate_stream(model, testset)
+    print 'Mean Absolute Error is: ' + str(metrics['all']['MAE'])
+    print 'Root Mean Squared Error is: ' + str(metrics['all']['RMSE'])
+    for name in CATEGORIES:
+        category = metrics[name]
+        print '%s: %d rows, MAE %s, RMSE %s' % (name, category['count'], category['MAE'], category['RMSE'])
+    if args['profile']:
+        instrument.profiler.flush()
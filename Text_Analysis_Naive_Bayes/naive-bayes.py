@@ -1,5 +1,8 @@
 from naive_bayes_functions import *
 import argparse
+import instrument
+import os
+import sys
 
 def parseArgument():
     """
@@ -7,21 +10,43 @@ def parseArgument():
     """
     parser = argparse.ArgumentParser(description='Parsing a file.')
     parser.add_argument('-d', nargs=1, required=True)
+    parser.add_argument('-k', type=int, default=3,
+                        help='number of cross validation folds')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='processes used to tokenize the documents and run the folds')
+    parser.add_argument('--token-cache', default=None,
+                        help='directory of a token cache shared with tfidf, created if missing')
+    parser.add_argument('--profile', nargs='?', const='-',
+                        help='record the time, calls, items and memory of each stage, logged to stderr '
+                             'or written as json to the given file')
     args = vars(parser.parse_args())
+    if args['k'] < 2:
+        parser.error('-k must be at least 2')
+    numdocs = len(sortclasses(args['d'][0])[1])
+    if args['k'] > numdocs:
+        parser.error('-k (%d) can not be more than the number of documents (%d)' % (args['k'], numdocs))
     return args
 
 def main():
     args = parseArgument()
     directory = args['d'][0]
     print directory
-    master, one, two, three = sortnsplit(directory)
-    print 'iteration 1'
-    firstresult = homeworkoutput(master, one + two, three)
-    print 'iteration 2'
-    secondresult = homeworkoutput(master, one + three, two)
-    print 'iteration 3'
-    thirdresult = homeworkoutput(master, two + three, one)
-    final = (firstresult + secondresult + thirdresult)/3
+    if args['profile']:
+        instrument.enable_from_option(args['profile'])
+    tokencache = None
+    if args['token_cache']:
+        sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+        from tokencache import TokenCache
+        tokencache = TokenCache(args['token_cache'])
+    master, folds = sortnsplitk(directory, args['k'])
+    results = crossvalidate(master, folds, args['workers'], tokencache)
+    for i, stats in enumerate(results):
+        print 'iteration', i + 1
+        printstats(stats)
+    final = sum(stats['accuracy'] for stats in results)/len(results)
     print 'ave_accuracy:', final, '%'
+    if args['profile']:
+        instrument.profiler.flush()
 
-main()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,18 @@
 import glob
+import json
+import multiprocessing
 import os
 import random
 import re
+import sys
 import collections
 import numpy as np
+from scipy import sparse
+try:
+    import instrument
+except ImportError:
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+    import instrument
 
 
 # takes x, a path to a directory. Directory should have subdirectories, containing all the
@@ -13,6 +22,18 @@ import numpy as np
 # the entire corpus divided into 2/3 (a training set) and 1/3 (a test set) who are non-overlapping
 # the sample set can be changed if desired...
 def sortnsplit(x):
+    Cidentity, Master = sortclasses(x)
+    group1 = random.sample(Master, ((len(Master))/3))
+    remaining = set(Master).difference(group1)
+    group2 = random.sample(remaining, ((len(Master))/3))
+    group3 = set(remaining).difference(group2)
+    group3 = list(group3)
+    return (Cidentity, group1, group2, group3)
+
+
+# the first half of sortnsplit: returns Cidentity and Master, the list
+# of all the files
+def sortclasses(x):
     Clist = os.listdir(x)
     Cidentity = {}
     Master = []
@@ -23,12 +44,17 @@ def sortnsplit(x):
             Cidentity[i] = lfiles
             for j in lfiles:
                 Master.append(j)
-    group1 = random.sample(Master, ((len(Master))/3))
-    remaining = set(Master).difference(group1)
-    group2 = random.sample(remaining, ((len(Master))/3))
-    group3 = set(remaining).difference(group2)
-    group3 = list(group3)
-    return (Cidentity, group1, group2, group3)
+    return (Cidentity, Master)
+
+
+# same as sortnsplit, but splits the corpus into k non-overlapping folds
+# of (nearly) the same size instead of three, returns Cidentity and the
+# list of folds
+def sortnsplitk(x, k=3):
+    Cidentity, Master = sortclasses(x)
+    random.shuffle(Master)
+    folds = [Master[i::k] for i in range(k)]
+    return (Cidentity, folds)
 
 
 # takes a list of filepaths and re-sorts them according to the classes
@@ -42,18 +68,58 @@ def assignsample(x, identitydict):
     return (positive, negative)
 
 
+# assignsample for any number of classes: returns a dictionary of every
+# class in identitydict with the list of filepaths of x in that class
+def assignclasses(x, identitydict):
+    x = set(x)
+    return dict((c, [path for path in identitydict[c] if path in x]) for c in identitydict)
+
+
 # takes a list of filepaths and turns the content in those files into
-# a BAG OF WORDS!
+# a BAG OF WORDS! each file is read and tokenized on its own and the
+# words are added to the list, instead of gluing all the files into
+# one big string first (the files were joined with a space, so no word
+# ever ran across two files and the words come out the same)
 def bagofwords(x):
-    text = ''
+    text = []
     for path in x:
         a = open(path, 'r')
-        text = text + ' ' + a.read()
+        text.extend(tokenize(a.read()))
         a.close()
+    return text
+
+
+# same words as bagofwords, but counted straight into a Counter one file
+# at a time, so only one file's words are ever held in memory. pass in
+# counts to keep adding to an existing Counter. tokencache can be a
+# TokenCache (from tokencache.py at the top of the repo), then the words
+# of files it already has are read from it instead of tokenized again
+@instrument.profiled()
+def countwords(x, counts=None, tokencache=None):
+    if counts is None:
+        counts = collections.Counter()
+    for path in x:
+        if tokencache is not None:
+            counts.update(tokencache.counts(path, 'naive_bayes', filewords))
+        else:
+            counts.update(filewords(path))
+    return counts
+
+
+# the words of one file, the tokenizer a TokenCache caches for this code
+def filewords(path):
+    a = open(path, 'r')
+    words = tokenize(a.read())
+    a.close()
+    return words
+
+
+# strips everything but letters and whitespace out of a string, lowercases
+# it and splits it into a list of words
+def tokenize(text):
     text = re.sub('[^A-Za-z\s]', '', text)
     text = text.lower()
-    text = text.split()
-    return text
+    return text.split()
 
 
 # takes two lists, each a list of paths for a particular class
@@ -65,39 +131,45 @@ def bagofwords(x):
 # each class as the keys, and inside each class's dictionary is a
 # dictionary, with p(c) inside the key 'pc' and the Counter object
 # with every word's p(w|c) inside the key pwc
+@instrument.profiled()
 def trainingdata(pos, neg):
-    trained = {}
-    # so P(c), the probability of the class to the total group of training docs
-    trained['pos'] = {}
-    trained['neg'] = {}
-    trained['pos']['pc'] = len(pos)/float(len(pos) + len(neg))
-    trained['neg']['pc'] = len(neg)/float(len(pos) + len(neg))
-    posbag = bagofwords(pos)
-    negbag = bagofwords(neg)
-    poswordcount = float(len(posbag))
-    negwordcount = float(len(negbag))
     # so this creates a frequency map of each word for each class...
     # right now, it's NOT in probability terms, just the number of each
-    # word in each class
-    trained['pos']['pwc'] = collections.Counter(posbag)
-    trained['neg']['pwc'] = collections.Counter(negbag)
+    # word in each class, the files are counted one at a time
+    return trainingcounts(countwords(pos), countwords(neg), len(pos), len(neg))
+
+
+# the rest of trainingdata, for word counts that are already made:
+# poscounts and negcounts are Counters of every word in each class
+# (they are turned into the p(w|c) maps in place), numpos and numneg
+# the number of documents in each class
+def trainingcounts(poscounts, negcounts, numpos, numneg):
+    return classtraining({'pos': poscounts, 'neg': negcounts}, {'pos': numpos, 'neg': numneg})
+
+
+# trainingcounts for any number of classes: counts maps every class to
+# the Counter of its words (turned into its p(w|c) map in place) and
+# numdocs every class to its number of documents
+def classtraining(counts, numdocs):
+    trained = {}
+    total = float(sum(numdocs.values()))
     # V is the number of unique words in the entire superset
-    V = len(set(trained['pos']['pwc']).union(set(trained['neg']['pwc'])))
-    # create iterkeys just so we can do stuff faster
-    positer1 = trained['pos']['pwc'].iterkeys()
-    negiter1 = trained['neg']['pwc'].iterkeys()
-    # convert the COUNT of each word in the wordfreqs to a conditional probability,
-    # p(w|c) = (count(w,c) + 1) / (count(c) + |v| + 1)
-    for i in positer1:
-        trained['pos']['pwc'][i] = (trained['pos']['pwc'][i] + 1)/(poswordcount + V + 1)
-    for i in negiter1:
-        trained['neg']['pwc'][i] = (trained['neg']['pwc'][i] + 1)/(negwordcount + V + 1)
-    # adding my UNK probabilities now so I can reference it later
-    # in the actual check class function... note, I labeled it 'UNK0' because I know
-    # no words in the corpus will be called this because I already stripped out all numbers
-    # earlier in the bag of words
-    trained['pos']['pwc']['UNK0'] = 1/(poswordcount + V + 1)
-    trained['neg']['pwc']['UNK0'] = 1/(negwordcount + V + 1)
+    V = len(set().union(*counts.values()))
+    for c in counts:
+        # so P(c), the probability of the class to the total group of training docs
+        trained[c] = {}
+        trained[c]['pc'] = numdocs[c]/total
+        trained[c]['pwc'] = counts[c]
+        wordcount = float(sum(counts[c].values()))
+        # convert the COUNT of each word in the wordfreqs to a conditional probability,
+        # p(w|c) = (count(w,c) + 1) / (count(c) + |v| + 1)
+        for i in counts[c].iterkeys():
+            counts[c][i] = (counts[c][i] + 1)/(wordcount + V + 1)
+        # adding my UNK probabilities now so I can reference it later
+        # in the actual check class function... note, I labeled it 'UNK0' because I know
+        # no words in the corpus will be called this because I already stripped out all numbers
+        # earlier in the bag of words
+        counts[c]['UNK0'] = 1/(wordcount + V + 1)
     return trained
 
 # just wrote some code because I wanted to test out the naive bayes and conditional
@@ -119,6 +191,7 @@ def trainingdata(pos, neg):
 # run a naive bayes algo on a new document, needs existing trained data, and
 # will compare the naive bayes calculation for each class and return the class
 # most likely
+@instrument.profiled()
 def naivebayes(path, trainedata):
     # note, I'm defining this function to look at one document at a time, but
     # since bag of words expects a list of paths, I just put the one path into
@@ -137,16 +210,82 @@ def naivebayes(path, trainedata):
         bayes[score] = i
     return bayes[max(bayes)]
 
-# this function takes a list of paths, the testing set, and uses
-# the bayes method with naivebayes function on each path, and
-# returns a dictionary of classes with the filepaths of all the
-# documents that are predicted to be in that path
-# note, I've hardcoded pos and neg, so this function is specific to
-# this homework
-def assigntestgroup(listpaths, traindata):
-    result = {'pos':[],'neg':[]}
-    for i in listpaths:
-        guess = naivebayes(i, traindata)
+# turns trained data (from trainingdata) into arrays so whole batches of
+# documents can be scored at once: returns a dictionary with the sorted
+# list of classes under 'classes', a map of every word in the training
+# data to its column under 'vocabulary', log p(c) of each class under
+# 'logpc', and under 'logpwc' a classes x (words + 1) matrix of log p(w|c),
+# where a word a class never saw gets that class's UNK0 probability, and
+# the last column is UNK0 for words no class saw at all
+@instrument.profiled()
+def compiletrained(trainedata):
+    classes = sorted(trainedata)
+    words = set()
+    for i in classes:
+        words.update(trainedata[i]['pwc'])
+    words.discard('UNK0')
+    words = sorted(words)
+    vocabulary = dict((w, j) for j, w in enumerate(words))
+    logpwc = np.zeros((len(classes), len(words) + 1))
+    logpc = np.zeros(len(classes))
+    for k, i in enumerate(classes):
+        pwc = trainedata[i]['pwc']
+        unk = pwc['UNK0']
+        logpwc[k] = np.log([pwc[w] or unk for w in words] + [unk])
+        logpc[k] = np.log(trainedata[i]['pc'])
+    return {'classes': classes, 'vocabulary': vocabulary, 'logpc': logpc, 'logpwc': logpwc}
+
+# makes a sparse documents x (words + 1) matrix of word counts for a list
+# of paths, words that aren't in vocabulary are counted in the last column.
+# cache can map paths to their word Counters (see countdocs), so the files
+# aren't read again
+def countmatrix(listpaths, vocabulary, cache=None):
+    unk = len(vocabulary)
+    indptr = [0]
+    indices = []
+    counts = []
+    for path in listpaths:
+        if cache is not None:
+            words = cache[path]
+        else:
+            words = countwords([path])
+        columns = collections.Counter()
+        for w in words:
+            columns[vocabulary.get(w, unk)] += words[w]
+        indices.extend(columns.keys())
+        counts.extend(columns.values())
+        indptr.append(len(indices))
+    return sparse.csr_matrix((np.array(counts, dtype=np.float64), np.array(indices, dtype=np.int64),
+                              np.array(indptr, dtype=np.int64)), shape=(len(listpaths), unk + 1))
+
+# the naive bayes score of every class for every document in a list of
+# paths, in one sparse matrix product: returns (guesses, scores, classes)
+# where scores is a documents x classes array of log scores (log p(c) plus
+# the sum of log p(w|c) over the words), classes gives the class of each
+# column and guesses the best class for each document. traindata can be
+# trained data from trainingdata, already compiled with compiletrained,
+# or a NaiveBayesModel, cache is passed on to countmatrix
+@instrument.profiled(items=lambda result: len(result[0]))
+def classifybatch(listpaths, traindata, cache=None):
+    if isinstance(traindata, NaiveBayesModel):
+        traindata = traindata.compile()
+    elif 'logpwc' not in traindata:
+        traindata = compiletrained(traindata)
+    counts = countmatrix(listpaths, traindata['vocabulary'], cache)
+    scores = np.asarray(counts.dot(traindata['logpwc'].T)) + traindata['logpc']
+    classes = traindata['classes']
+    guesses = [classes[k] for k in np.argmax(scores, axis=1)] if len(listpaths) else []
+    return (guesses, scores, classes)
+
+# this function takes a list of paths, the testing set, and classifies
+# them all at once with classifybatch (same answers as running the
+# naivebayes function on each path), and returns a dictionary of classes
+# with the filepaths of all the documents that are predicted to be in
+# that path, every class of traindata gets a (maybe empty) list
+def assigntestgroup(listpaths, traindata, cache=None):
+    guesses, scores, classes = classifybatch(listpaths, traindata, cache)
+    result = dict((c, []) for c in classes)
+    for i, guess in zip(listpaths, guesses):
         result[guess].append(i)
     return result
 
@@ -162,21 +301,276 @@ def homeworkoutput(master, training, testgroup):
     trainpos, trainneg = assignsample(training, master)
     trainedmap = trainingdata(trainpos, trainneg)
     testing = assigntestgroup(testgroup, trainedmap)
-    numtrainpos = len(trainpos)
-    numtrainneg = len(trainneg)
-    testpos, testneg = assignsample(testgroup, master)
-    numtestpos = len(testpos)
-    numtestneg = len(testneg)
-    poscor, posincor = assignsample(testing['pos'], master)
-    negincor, negcor = assignsample(testing['neg'], master)
-    numposcorrect = len(poscor)
-    numnegcorrect = len(negcor)
-    print 'num_pos_test_docs:', numtestpos
-    print 'num_pos_training_docs:', numtrainpos
-    print 'num_pos_correct_docs:', numposcorrect
-    print 'num_neg_test_docs:', numtestneg
-    print 'num_neg_training_docs:', numtrainneg
-    print 'num_neg_correct_docs:', numnegcorrect
-    accuracy = round((((numposcorrect + numnegcorrect)/float(len(testgroup)))*100),2)
-    print 'accuracy:', accuracy, '%'
-    return accuracy
\ No newline at end of file
+    stats = foldstats(master, training, testgroup, testing)
+    printstats(stats)
+    return stats['accuracy']
+
+
+# the numbers homeworkoutput prints, as a dictionary, for the training
+# and test lists of paths and testing, the result of assigntestgroup.
+# every class c of master gets num_c_test_docs, num_c_training_docs and
+# num_c_correct_docs, and stats['classes'] lists the classes in the
+# order they are printed (pos and neg first, like homeworkoutput did)
+def foldstats(master, training, testgroup, testing):
+    stats = {}
+    trained = assignclasses(training, master)
+    tested = assignclasses(testgroup, master)
+    stats['classes'] = sorted(master, key=lambda c: ({'pos': 0, 'neg': 1}.get(c, 2), c))
+    numcorrect = 0
+    for c in stats['classes']:
+        correct = set(testing.get(c, [])).intersection(master[c])
+        stats['num_%s_test_docs' % c] = len(tested[c])
+        stats['num_%s_training_docs' % c] = len(trained[c])
+        stats['num_%s_correct_docs' % c] = len(correct)
+        numcorrect += len(correct)
+    stats['accuracy'] = round(((numcorrect/float(len(testgroup)))*100),2)
+    return stats
+
+
+def printstats(stats):
+    for c in stats['classes']:
+        for i in ['num_%s_test_docs', 'num_%s_training_docs', 'num_%s_correct_docs']:
+            print i % c + ':', stats[i % c]
+    print 'accuracy:', stats['accuracy'], '%'
+
+
+# tokenizes every file in a list of paths exactly once and returns a
+# dictionary mapping each path to the Counter of its words, with
+# workers > 1 the files are counted in a pool of that many processes.
+# with a tokencache only the files it doesn't have yet are tokenized
+@instrument.profiled(items=len)
+def countdocs(listpaths, workers=1, tokencache=None):
+    if tokencache is not None:
+        tokencache.update(listpaths, 'naive_bayes', filewords, workers)
+        return dict((path, countwords([path], tokencache=tokencache)) for path in listpaths)
+    if workers <= 1:
+        return dict(map(countfile, listpaths))
+    pool = multiprocessing.Pool(workers)
+    try:
+        cache = dict(pool.imap(countfile, listpaths, 64))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return cache
+
+def countfile(path):
+    return (path, countwords([path]))
+
+
+# k-fold cross validation over folds (lists of paths, as from sortnsplitk)
+# that only reads and tokenizes each document once: every document's word
+# counts are cached by countdocs, the word totals of every class of the
+# whole corpus are added up once, and each fold's training counts are the totals
+# minus the counts of the documents it holds out, which gives the same
+# model as trainingdata on the other folds (for any number of classes). with workers > 1 the folds
+# run in a pool of that many processes, tokencache is passed on to
+# countdocs. returns the foldstats of each fold
+@instrument.profiled(items=len)
+def crossvalidate(master, folds, workers=1, tokencache=None):
+    allpaths = [path for fold in folds for path in fold]
+    cache = countdocs(allpaths, workers, tokencache)
+    state = (master, folds, cache, classcounts(allpaths, master, cache))
+    if workers <= 1:
+        initfolds(state)
+        return [runfold(i) for i in range(len(folds))]
+    pool = multiprocessing.Pool(workers, initfolds, (state,))
+    try:
+        results = pool.map(runfold, range(len(folds)))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return results
+
+# the word totals of every class of master in a list of paths, from the
+# cached counts, as a dictionary of class -> Counter
+def classcounts(listpaths, master, cache):
+    counts = {}
+    for c, paths in assignclasses(listpaths, master).items():
+        counts[c] = collections.Counter()
+        for path in paths:
+            counts[c].update(cache[path])
+    return counts
+
+_foldstate = None
+
+def initfolds(state):
+    global _foldstate
+    _foldstate = state
+
+# trains on every fold but fold i and tests on fold i, using the state
+# crossvalidate set up (in this process or in the pool's initializer)
+def runfold(i):
+    master, folds, cache, totals = _foldstate
+    testgroup = folds[i]
+    training = [path for j, fold in enumerate(folds) if j != i for path in fold]
+    held = classcounts(testgroup, master, cache)
+    # Counter subtraction drops the words whose count goes to 0, so the
+    # vocabulary is only the words of the training documents
+    counts = dict((c, totals[c] - held[c]) for c in totals)
+    numdocs = dict((c, len(paths)) for c, paths in assignclasses(training, master).items())
+    trainedmap = classtraining(counts, numdocs)
+    testing = assigntestgroup(testgroup, trainedmap, cache)
+    return foldstats(master, training, testgroup, testing)
+
+
+# a naive bayes model for any number of classes that can keep learning:
+# the word counts of every class are kept in one classes x words int32
+# array, with the words in a vocabulary shared by all the classes, next to
+# the number of documents of each class. the array is a view of a bigger
+# buffer, each axis of which doubles when it runs out of room, so adding a
+# few documents with new words doesn't copy all the counts. a count that
+# would pass the int32 maximum makes the buffer int64 (once) instead of
+# wrapping around. partial_fit adds newly labeled
+# documents without going over the old ones again, and the probabilities
+# are the ones trainingdata computes, p(c) = docs(c) / docs and
+# p(w|c) = (count(w,c) + 1) / (count(c) + |v| + 1), with the UNK0
+# probability 1 / (count(c) + |v| + 1) for words the model never saw.
+# save writes the arrays to a directory, load memory-maps them back
+MODEL_VERSION = 1
+
+class NaiveBayesModel(object):
+
+    def __init__(self, classes=()):
+        self.classes = []
+        self.classindex = {}
+        self.words = []
+        self.vocabulary = {}
+        self.buffer = np.zeros((0, 0), dtype=np.int32)
+        self.counts = self.buffer
+        self.doccounts = np.zeros(0, dtype=np.int64)
+        self.compiled = None
+        for c in classes:
+            self.addclass(c)
+        self.resize()
+
+    # trains a model on a directory laid out like sortnsplit expects, one
+    # subdirectory of .txt files per class
+    @classmethod
+    def from_directory(cls, x):
+        Cidentity = sortclasses(x)[0]
+        model = cls(sorted(Cidentity))
+        for c in model.classes:
+            model.partial_fit(Cidentity[c], [c] * len(Cidentity[c]))
+        return model
+
+    def addclass(self, c):
+        self.classindex[c] = len(self.classes)
+        self.classes.append(c)
+
+    # grows counts and doccounts to the current classes and words. counts
+    # only gets a new buffer when it outgrows the old one, with the axis
+    # that ran out of room doubled (or just big enough), or once after
+    # load, to copy the read-only memory-mapped counts into memory (keeping
+    # the dtype they were saved with)
+    def resize(self):
+        shape = (len(self.classes), len(self.words))
+        if self.buffer is None:
+            self.buffer = np.zeros(shape, dtype=np.promote_types(self.counts.dtype, np.int32))
+            self.buffer[:self.counts.shape[0], :self.counts.shape[1]] = self.counts
+        elif shape[0] > self.buffer.shape[0] or shape[1] > self.buffer.shape[1]:
+            capacity = [n if n <= size else max(n, 2 * size) for n, size in zip(shape, self.buffer.shape)]
+            buffer = np.zeros(capacity, dtype=self.buffer.dtype)
+            buffer[:self.counts.shape[0], :self.counts.shape[1]] = self.counts
+            self.buffer = buffer
+        self.counts = self.buffer[:shape[0], :shape[1]]
+        if len(self.doccounts) != shape[0] or not self.doccounts.flags.writeable:
+            doccounts = np.zeros(shape[0], dtype=np.int64)
+            doccounts[:len(self.doccounts)] = self.doccounts
+            self.doccounts = doccounts
+
+    # makes the buffer int64, when a count no longer fits in int32
+    def widen(self):
+        self.buffer = self.buffer.astype(np.int64)
+        self.counts = self.buffer[:self.counts.shape[0], :self.counts.shape[1]]
+
+    # adds the documents in listpaths, labels[i] being the class of
+    # listpaths[i], to the counts. new classes and words are added as they
+    # come up. cache can map paths to their word Counters, as in countmatrix
+    @instrument.profiled('NaiveBayesModel.partial_fit')
+    def partial_fit(self, listpaths, labels, cache=None):
+        rows = []
+        columns = []
+        values = []
+        docs = []
+        for path, label in zip(listpaths, labels):
+            if label not in self.classindex:
+                self.addclass(label)
+            k = self.classindex[label]
+            words = cache[path] if cache is not None else countwords([path])
+            for w, n in words.items():
+                j = self.vocabulary.get(w)
+                if j is None:
+                    j = self.vocabulary[w] = len(self.words)
+                    self.words.append(w)
+                rows.append(k)
+                columns.append(j)
+                values.append(n)
+            docs.append(k)
+        self.resize()
+        # sum the batch per (class, word) first, so the new totals can be
+        # checked against the dtype before they are written
+        batch = sparse.coo_matrix((np.array(values, dtype=np.int64),
+                                   (np.array(rows, dtype=np.int64), np.array(columns, dtype=np.int64))),
+                                  shape=self.counts.shape)
+        batch.sum_duplicates()
+        totals = self.counts[batch.row, batch.col].astype(np.int64) + batch.data
+        if len(totals) and totals.max() > np.iinfo(self.counts.dtype).max:
+            self.widen()
+        self.counts[batch.row, batch.col] = totals
+        np.add.at(self.doccounts, np.array(docs, dtype=np.int64), 1)
+        self.compiled = None
+        return self
+
+    # the model as log probability tables, in the form compiletrained
+    # returns, so it can be passed to classifybatch
+    def compile(self):
+        if self.compiled is None:
+            V = len(self.words)
+            denominators = self.counts.sum(axis=1, dtype=np.int64) + V + 1.0
+            logpwc = np.zeros((len(self.classes), V + 1))
+            logpwc[:, :V] = np.log((self.counts + 1.0)/denominators[:, None])
+            logpwc[:, V] = np.log(1/denominators)
+            with np.errstate(divide='ignore'):
+                logpc = np.log(self.doccounts/float(self.doccounts.sum()))
+            self.compiled = {'classes': list(self.classes), 'vocabulary': self.vocabulary,
+                             'logpc': logpc, 'logpwc': logpwc}
+        return self.compiled
+
+    # classifies a list of paths, returns (guesses, scores, classes) like
+    # classifybatch
+    def predict(self, listpaths, cache=None):
+        return classifybatch(listpaths, self.compile(), cache)
+
+    # writes the model to the directory path: counts.npy, doccounts.npy and
+    # meta.json with the classes and the words in column order
+    def save(self, path):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        np.save(os.path.join(path, 'counts.npy'), self.counts)
+        np.save(os.path.join(path, 'doccounts.npy'), self.doccounts)
+        f = open(os.path.join(path, 'meta.json'), 'w')
+        try:
+            json.dump({'version': MODEL_VERSION, 'classes': self.classes, 'words': self.words}, f)
+        finally:
+            f.close()
+
+    # reads a model written by save, the count arrays are memory-mapped
+    # read only until the next partial_fit copies them (once)
+    @classmethod
+    def load(cls, path):
+        f = open(os.path.join(path, 'meta.json'))
+        try:
+            meta = json.load(f)
+        finally:
+            f.close()
+        if meta['version'] != MODEL_VERSION:
+            raise ValueError('%s has model version %s, expected %d' % (path, meta['version'], MODEL_VERSION))
+        model = cls(meta['classes'])
+        model.words = [str(w) for w in meta['words']]
+        model.vocabulary = dict((w, j) for j, w in enumerate(model.words))
+        model.counts = np.load(os.path.join(path, 'counts.npy'), mmap_mode='r')
+        model.doccounts = np.load(os.path.join(path, 'doccounts.npy'), mmap_mode='r')
+        model.buffer = None
+        return model
@@ -0,0 +1,276 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+for d in (HERE, ROOT, os.path.join(ROOT, 'Collaborative_Filtering'), os.path.join(ROOT, 'tfidf'),
+          os.path.join(ROOT, 'Text_Analysis_Naive_Bayes')):
+    if d not in sys.path:
+        sys.path.append(d)
+
+import generators
+import instrument
+
+
+# benchmark harness for the four pipelines of the repo. every case runs in
+# its own process (so its peak memory is its own) over synthetic data from
+# generators.py, times each stage and records the peak resident memory so
+# far after it. results are written as json and can be compared against a
+# stored baseline run:
+#   python benchmarks/bench.py --out results.json
+#   python benchmarks/bench.py --baseline results.json --out new.json
+
+# the sizes each case is run at by default, rows of ratings or clicks for
+# cf and clicks, documents for tfidf and nb
+SIZES = {
+    'cf': [10000, 50000, 200000],
+    'clicks': [10000, 50000, 200000],
+    'tfidf': [200, 1000, 5000],
+    'nb': [200, 1000, 5000],
+}
+
+
+# runs func(*args), records its wall time and the peak memory after it as
+# stages[name] and returns what func returned
+def stage(stages, name, func, *args, **kwargs):
+    start = time.time()
+    result = func(*args, **kwargs)
+    stages[name] = {'seconds': time.time() - start, 'peak_rss_kb': instrument.peak_rss()}
+    return result
+
+
+# the data files of a case, generated into datadir the first time
+def prepare(case, size, seed, datadir):
+    path = os.path.join(datadir, '%s-%d-%d' % (case, size, seed))
+    files = {
+        'cf': {'train': os.path.join(path, 'train.csv'), 'test': os.path.join(path, 'test.csv')},
+        'clicks': {'train': os.path.join(path, 'train.csv'), 'test': os.path.join(path, 'test.csv'),
+                   'advertisers': os.path.join(path, 'advertisers.csv')},
+        'tfidf': {'directory': os.path.join(path, 'articles')},
+        'nb': {'directory': os.path.join(path, 'reviews')},
+    }[case]
+    if not os.path.exists(os.path.join(path, 'done')):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        if case == 'cf':
+            generators.ratings(files['train'], files['test'], size, seed)
+        elif case == 'clicks':
+            generators.clicks(files['train'], files['test'], files['advertisers'], size, seed)
+        elif case == 'tfidf':
+            generators.articles(files['directory'], size, seed)
+        else:
+            generators.reviews(files['directory'], size, 2, seed)
+        open(os.path.join(path, 'done'), 'w').close()
+    files['path'] = path
+    return files
+
+
+# the dense user x user model of train_data (and test_data's predict loop
+# over it) is only timed up to this many users, it grows with their square
+DENSE_USERS = 1000
+
+def bench_cf(files, stages):
+    import numpy as np
+    import cf
+    store = stage(stages, 'load', cf.RatingsStore.from_csv, files['train'])
+    stage(stages, 'similarity', lambda: sum(block[2].nnz for block in cf.similarity_blocks(store)))
+    model = stage(stages, 'train_neighbors', cf.train_neighbors, store, 50)
+    pairs = cf.predict_list(files['test'])
+    predictions = stage(stages, 'predict_batch', model.predict_batch, pairs)
+    stage(stages, 'evaluate_stream', cf.evaluate_stream, model, files['test'],
+          os.path.join(files['path'], 'predictions.txt'))
+    # a loaded model scores from read-only memory maps of the file, it has
+    # to give the predictions of the model it was saved from
+    modelfile = os.path.join(files['path'], 'model.bin')
+    stage(stages, 'save_model', cf.save_model, model, modelfile)
+    loaded = stage(stages, 'load_model', cf.load_model, modelfile)
+    loaded_predictions = stage(stages, 'predict_batch_loaded', loaded.predict_batch, pairs)
+    if not np.allclose(loaded_predictions, predictions):
+        raise AssertionError('the loaded model predicts differently from the saved one')
+    stage(stages, 'evaluate_stream_loaded', cf.evaluate_stream, loaded, files['test'],
+          os.path.join(files['path'], 'predictions.txt'))
+    # folding in a single new rating, against train_neighbors above
+    stage(stages, 'update_one', model.update, pairs[:1])
+    # the end to end paths of cf.py's main
+    model = stage(stages, 'train_data_k50', cf.train_data, files['train'], k=50)[0]
+    stage(stages, 'test_data_k50', cf.test_data, model, files['train'], files['test'])
+    if len(store.users) <= DENSE_USERS:
+        model = stage(stages, 'train_data', cf.train_data, files['train'])[0]
+        stage(stages, 'test_data', cf.test_data, model, files['train'], files['test'])
+
+def bench_clicks(files, stages):
+    import numpy as np
+    import collaborative_filtering as clicks
+    data = stage(stages, 'load', lambda: np.concatenate((clicks.load_clicks(files['train']),
+                                                         clicks.load_clicks(files['test']))))
+    userlist = stage(stages, 'build_userlist', clicks.build_userlist, data)
+    users = sorted(set(str(i[0]) for i in clicks.load_clicks(files['test'])))
+    advertisers = clicks.load_advertisers(files['advertisers'])
+    outfile = os.path.join(files['path'], 'recommendations.csv')
+    recommender = stage(stages, 'fit_exact', clicks.Recommender().fit, userlist)
+    stage(stages, 'recommend_exact', clicks.write_recommendations, recommender, users, advertisers, outfile, 5)
+    recommender = stage(stages, 'fit_lsh', clicks.Recommender(approximate=True).fit, userlist)
+    stage(stages, 'recommend_lsh', clicks.write_recommendations, recommender, users, advertisers, outfile, 5)
+
+# runs func as stage name with tfidf.count_files wrapped, returns the
+# largest number of files count_files was given at once
+def counted_stage(stages, name, func, *args, **kwargs):
+    import tfidf
+    largest = [0]
+    count_files = tfidf.count_files
+    def counted(listoffiles):
+        largest[0] = max(largest[0], len(listoffiles))
+        return count_files(listoffiles)
+    tfidf.count_files = counted
+    try:
+        stage(stages, name, func, *args, **kwargs)
+    finally:
+        tfidf.count_files = count_files
+    return largest[0]
+
+def bench_tfidf(files, stages):
+    import tfidf
+    docs = stage(stages, 'filelist', tfidf.filelist, os.path.join(files['directory'], '*.xml'))
+    stage(stages, 'create_tfidf_map', tfidf.create_tfidf_map, docs)
+    stage(stages, 'create_tfidf_matrix', tfidf.create_tfidf_matrix, docs)
+    stage(stages, 'create_tfidf_matrix_hashed', tfidf.create_tfidf_matrix, docs, n_features=2**18)
+    # the out of core pass one and the index build have to count the files
+    # a chunk at a time, so no more than chunksize documents' term Counters
+    # are alive at once
+    largest = counted_stage(stages, 'create_tfidf_chunks', tfidf.create_tfidf_chunks, docs,
+                            os.path.join(files['path'], 'chunks'), memory=2**20, chunksize=64)
+    if largest > 64:
+        raise AssertionError('create_tfidf_chunks counted %d files at once' % largest)
+    indexpath = os.path.join(files['path'], 'index.db')
+    if os.path.exists(indexpath):
+        os.remove(indexpath)
+    largest = counted_stage(stages, 'update_index', tfidf.update_index, indexpath, docs, chunksize=64)
+    if largest > 64:
+        raise AssertionError('update_index counted %d files at once' % largest)
+    search = stage(stages, 'search_index', tfidf.SearchIndex.from_files, docs)
+    # keyword queries (the first few words of a document) and whole
+    # documents as queries, each against the same search done by brute force
+    documents = [tfidf.words(tfidf.get_text(f)) for f in docs[:100]]
+    queries = [words[:4] for words in documents]
+    stage(stages, 'search_queries', lambda: [search.query_words(q, 10) for q in queries])
+    stage(stages, 'search_queries_bruteforce', lambda: [search.scan_words(q, 10) for q in queries])
+    stage(stages, 'search_documents', lambda: [search.query_words(q, 10) for q in documents])
+    stage(stages, 'search_documents_bruteforce', lambda: [search.scan_words(q, 10) for q in documents])
+
+def bench_nb(files, stages):
+    import naive_bayes_functions as nb
+    master, paths = nb.sortclasses(files['directory'])
+    training = paths[:len(paths) * 2 // 3]
+    testing = paths[len(paths) * 2 // 3:]
+    pos, neg = nb.assignsample(training, master)
+    trained = stage(stages, 'trainingdata', nb.trainingdata, pos, neg)
+    stage(stages, 'classifybatch', nb.classifybatch, testing, trained)
+    stage(stages, 'naivebayes_100', lambda: [nb.naivebayes(p, trained) for p in testing[:100]])
+    folds = [paths[i::3] for i in range(3)]
+    stage(stages, 'crossvalidate_3', nb.crossvalidate, master, folds)
+    stage(stages, 'model_from_directory', nb.NaiveBayesModel.from_directory, files['directory'])
+
+CASES = {'cf': bench_cf, 'clicks': bench_clicks, 'tfidf': bench_tfidf, 'nb': bench_nb}
+
+
+# runs one case at one size in this process and returns its result
+def run_case(case, size, seed, datadir):
+    files = prepare(case, size, seed, datadir)
+    stages = {}
+    start = time.time()
+    CASES[case](files, stages)
+    return {'case': case, 'size': size, 'seed': seed, 'seconds': time.time() - start,
+            'peak_rss_kb': instrument.peak_rss(), 'stages': stages}
+
+# runs one case at one size in a new python process, the data is
+# generated here first so it doesn't count towards the case's memory
+def run_subprocess(case, size, seed, datadir):
+    prepare(case, size, seed, datadir)
+    command = [sys.executable, os.path.abspath(__file__), '--run-case', case, '--size', str(size),
+               '--seed', str(seed), '--data', datadir]
+    output = subprocess.check_output(command)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+# compares results to baseline (both as written by main), returns a list
+# of (case, size, stage, what, old, new) for every stage that got slower
+# or used more memory than tolerance allows. stages that took less than
+# min_seconds in both runs are too noisy to compare on time
+def compare(results, baseline, tolerance=0.2, min_seconds=0.05):
+    old = {}
+    for result in baseline['results']:
+        old[(result['case'], result['size'])] = result
+    regressions = []
+    for result in results['results']:
+        before = old.get((result['case'], result['size']))
+        if before is None:
+            continue
+        for name, now in sorted(result['stages'].items()):
+            then = before['stages'].get(name)
+            if then is None:
+                continue
+            if (max(now['seconds'], then['seconds']) >= min_seconds
+                    and now['seconds'] > then['seconds'] * (1 + tolerance)):
+                regressions.append((result['case'], result['size'], name, 'seconds',
+                                    then['seconds'], now['seconds']))
+        if (result['peak_rss_kb'] and before['peak_rss_kb']
+                and result['peak_rss_kb'] > before['peak_rss_kb'] * (1 + tolerance)):
+            regressions.append((result['case'], result['size'], 'all', 'peak_rss_kb',
+                                before['peak_rss_kb'], result['peak_rss_kb']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the ML_Algos pipelines on synthetic data')
+    parser.add_argument('--cases', default=','.join(sorted(CASES)),
+                        help='comma separated cases to run, out of ' + ', '.join(sorted(CASES)))
+    parser.add_argument('--sizes', help='comma separated sizes to run every case at, instead of the defaults')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the data generators')
+    parser.add_argument('--data', help='directory the generated data is kept in, a temporary one by default')
+    parser.add_argument('--out', help='write the results as json here')
+    parser.add_argument('--baseline', help='json results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='relative slowdown or memory growth that counts as a regression')
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    parser.add_argument('--size', type=int, help=argparse.SUPPRESS)
+    args = vars(parser.parse_args())
+    if args['run_case']:
+        print(json.dumps(run_case(args['run_case'], args['size'], args['seed'], args['data'])))
+        return
+    datadir = args['data'] or tempfile.mkdtemp(prefix='ml_algos_bench')
+    results = {'python': platform.python_version(), 'platform': platform.platform(),
+               'seed': args['seed'], 'results': []}
+    for case in args['cases'].split(','):
+        if case not in CASES:
+            parser.error('unknown case %s' % case)
+        if args['sizes']:
+            sizes = [int(size) for size in args['sizes'].split(',')]
+        else:
+            sizes = SIZES[case]
+        for size in sizes:
+            result = run_subprocess(case, size, args['seed'], datadir)
+            results['results'].append(result)
+            print('%-6s %8d %8.2fs %8s KB  %s' % (case, size, result['seconds'], result['peak_rss_kb'],
+                  '  '.join('%s %.3fs' % (name, result['stages'][name]['seconds'])
+                            for name in sorted(result['stages']))))
+    if args['out']:
+        with open(args['out'], 'w') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+    if args['baseline']:
+        with open(args['baseline']) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args['tolerance'])
+        for case, size, name, what, then, now in regressions:
+            print('regression: %s %d %s %s %s -> %s' % (case, size, name, what, then, now))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
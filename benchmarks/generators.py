@@ -0,0 +1,105 @@
+import os
+import random
+
+
+# seeded synthetic data for the benchmarks, the same seed and size always
+# give the same files. ids and words are drawn from power laws, so a few
+# users, movies, advertisers and words are very common and most are rare,
+# like in the real data sets
+
+# the index of a power law draw over count items, item 0 most common
+def powerlaw(rnd, count, alpha=1.2):
+    return min(int((rnd.paretovariate(alpha) - 1) * count / 20.0), count - 1)
+
+
+# ratings for cf.py: writes rows user,movie,rating (no header) to train and
+# rows // 5 held out rows to test, about 20 ratings per user and 50 per movie.
+# some test rows have a user or movie that is not in train, so every
+# fallback of the predictions gets used
+def ratings(train, test, rows, seed=0):
+    rnd = random.Random(seed)
+    users = max(rows // 20, 2)
+    movies = max(rows // 50, 2)
+    with open(train, 'w') as out:
+        for i in range(rows):
+            out.write('u%d,m%d,%d\n' % (powerlaw(rnd, users), powerlaw(rnd, movies, 1.0), rnd.randint(1, 5)))
+    with open(test, 'w') as out:
+        for i in range(rows // 5):
+            out.write('u%d,m%d,%d\n' % (powerlaw(rnd, users + users // 20 + 1),
+                                        powerlaw(rnd, movies + movies // 20 + 1, 1.0), rnd.randint(1, 5)))
+
+
+# click logs for collaborative_filtering.py: train and test csvs of
+# user,advertiser rows and the advertisers csv of id,name, all with a
+# header line, with rows training rows and rows // 10 testing rows
+def clicks(train, test, advertisers, rows, seed=0):
+    rnd = random.Random(seed)
+    users = max(rows // 8, 2)
+    adverts = max(rows // 100, 2)
+    with open(train, 'w') as out:
+        out.write('user,advertiser\n')
+        for i in range(rows):
+            out.write('%d,%d\n' % (rnd.randrange(users), powerlaw(rnd, adverts, 0.9)))
+    with open(test, 'w') as out:
+        out.write('user,advertiser\n')
+        for i in range(rows // 10):
+            out.write('%d,%d\n' % (rnd.randrange(users + users // 20 + 1), powerlaw(rnd, adverts, 0.9)))
+    with open(advertisers, 'w') as out:
+        out.write('id,name\n')
+        for i in range(adverts):
+            out.write('%d,advertiser %d\n' % (i, i))
+
+
+# the words of the generated documents, letters only so the tokenizers of
+# tfidf and naive bayes keep them as they are
+def vocabulary(rnd, size=20000):
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    return [''.join(rnd.choice(letters) for j in range(rnd.randint(3, 10))) for i in range(size)]
+
+def sentence(rnd, words, n, bias=None):
+    picked = []
+    for i in range(n):
+        if bias and rnd.random() < 0.1:
+            picked.append(rnd.choice(bias))
+        else:
+            picked.append(words[powerlaw(rnd, len(words), 1.0)])
+    return ' '.join(picked)
+
+
+# news articles for tfidf.py: docs XML files in directory, each with a
+# title, a text with a few <p> paragraphs, and some other tags and
+# punctuation for the parser and tokenizer to skip
+def articles(directory, docs, seed=0):
+    rnd = random.Random(seed)
+    words = vocabulary(rnd)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for i in range(docs):
+        paragraphs = ''.join('<p>%s, %d.</p>' % (sentence(rnd, words, rnd.randint(20, 120)), rnd.randint(0, 99))
+                             for j in range(rnd.randint(1, 6)))
+        with open(os.path.join(directory, 'article%06d.xml' % i), 'w') as out:
+            out.write('<newsitem><title>%s</title><headline>%s</headline><text>%s%s</text></newsitem>\n'
+                      % (sentence(rnd, words, 6), sentence(rnd, words, 8), sentence(rnd, words, 10), paragraphs))
+
+
+# labeled reviews for the naive bayes code: docs .txt files spread over
+# one subdirectory per class under directory (the layout sortnsplit reads),
+# named pos and neg for two classes and class00, class01, ... otherwise.
+# every class uses some words more often than the others
+def reviews(directory, docs, classes=2, seed=0):
+    rnd = random.Random(seed)
+    words = vocabulary(rnd)
+    if classes == 2:
+        names = ['pos', 'neg']
+    else:
+        names = ['class%02d' % k for k in range(classes)]
+    for name in names:
+        if not os.path.isdir(os.path.join(directory, name)):
+            os.makedirs(os.path.join(directory, name))
+    for i in range(docs):
+        k = rnd.randrange(classes)
+        bias = words[1000 + k * 100:1100 + k * 100]
+        lines = [sentence(rnd, words, rnd.randint(5, 30), bias).capitalize() + '.'
+                 for j in range(rnd.randint(2, 20))]
+        with open(os.path.join(directory, names[k], 'review%06d.txt' % i), 'w') as out:
+            out.write('\n'.join(lines) + '\n')
@@ -0,0 +1,181 @@
+import functools
+import json
+import sys
+import time
+from collections import OrderedDict
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# opt-in stage level profiling for the pipelines of this repo. code marks
+# its stages with the stage context manager or the profiled decorator, and
+# while the global profiler is disabled (the default) they cost one
+# attribute check. once enabled every named stage records its call count,
+# total wall time, the number of items it went through (when it says) and
+# the peak resident memory of the process after it, and flush hands the
+# report to the sinks: log_sink, json_sink or any callable
+#
+#   instrument.profiler.enable(instrument.log_sink())
+#   ... run the pipeline ...
+#   instrument.profiler.flush()
+#
+# stages run inside pool workers are recorded in those processes and are
+# not sent back, only the stage around the whole pooled call shows up
+
+class Profiler(object):
+
+    def __init__(self):
+        self.enabled = False
+        self.sinks = []
+        self.stats = OrderedDict()
+
+    # starts recording, every argument is a sink that flush calls with
+    # the report
+    def enable(self, *sinks):
+        self.enabled = True
+        self.sinks = list(sinks)
+        return self
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        self.stats = OrderedDict()
+
+    # a context manager timing the stage called name, items can be given
+    # here or added to the stage it yields with add(n)
+    def stage(self, name, items=None):
+        if not self.enabled:
+            return _NULL_STAGE
+        return Stage(self, name, items)
+
+    def record(self, name, seconds, items):
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = {'calls': 0, 'seconds': 0.0, 'items': 0, 'peak_rss_kb': None}
+        stats['calls'] += 1
+        stats['seconds'] += seconds
+        if items is not None:
+            stats['items'] += items
+        stats['peak_rss_kb'] = peak_rss()
+
+    # the recorded stages, in the order they first finished, as a dict of
+    # name -> calls, seconds, items, items_per_second and peak_rss_kb
+    def report(self):
+        report = OrderedDict()
+        for name, stats in self.stats.items():
+            report[name] = dict(stats)
+            if stats['items'] and stats['seconds'] > 0:
+                report[name]['items_per_second'] = stats['items'] / stats['seconds']
+            else:
+                report[name]['items_per_second'] = None
+        return report
+
+    # sends the report to every sink
+    def flush(self):
+        report = self.report()
+        for sink in self.sinks:
+            sink(report)
+        return report
+
+
+class Stage(object):
+
+    def __init__(self, profiler, name, items=None):
+        self.profiler = profiler
+        self.name = name
+        self.items = items
+
+    def add(self, n):
+        self.items = (self.items or 0) + n
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, time.time() - self.start, self.items)
+        return False
+
+
+class NullStage(object):
+
+    def add(self, n):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_STAGE = NullStage()
+
+profiler = Profiler()
+
+
+# the stage context manager of the global profiler
+def stage(name, items=None):
+    return profiler.stage(name, items)
+
+# decorator recording every call of the function as the stage name (the
+# function's name by default). items, if given, is called with the
+# function's result and returns the number of items it went through
+def profiled(name=None, items=None):
+    def decorate(func):
+        stagename = name or func.__name__
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return func(*args, **kwargs)
+            start = time.time()
+            result = func(*args, **kwargs)
+            profiler.record(stagename, time.time() - start, items(result) if items else None)
+            return result
+        return wrapper
+    return decorate
+
+
+# peak resident memory of this process so far, in kilobytes (None where
+# the resource module is missing)
+def peak_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+
+# a sink writing one line per stage to stream (stderr by default)
+def log_sink(stream=None):
+    def sink(report):
+        out = stream or sys.stderr
+        for name, stats in report.items():
+            line = 'profile %s: %d calls, %.3fs' % (name, stats['calls'], stats['seconds'])
+            if stats['items']:
+                line += ', %d items' % stats['items']
+            if stats['items_per_second']:
+                line += ', %.1f items/s' % stats['items_per_second']
+            if stats['peak_rss_kb'] is not None:
+                line += ', peak rss %d KB' % stats['peak_rss_kb']
+            out.write(line + '\n')
+    return sink
+
+# a sink writing the report as json to path
+def json_sink(path):
+    def sink(report):
+        with open(path, 'w') as out:
+            json.dump(report, out, indent=2)
+    return sink
+
+# enables the global profiler for a --profile command line option: '-'
+# logs to stderr, anything else is a path for a json report. returns the
+# profiler, call flush on it at the end of the run
+def enable_from_option(option):
+    if option == '-':
+        return profiler.enable(log_sink())
+    return profiler.enable(json_sink(option))
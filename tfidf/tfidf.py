@@ -1,10 +1,21 @@
 import xml.etree.cElementTree as ET
+import functools
 import glob
+import multiprocessing
 import os
 import re
+import sqlite3
+import sys
+import zlib
 # note importing Counter directly instead of as something to match with test_tfidf.py format
 from collections import Counter
 import numpy as np
+from scipy import sparse
+try:
+    import instrument
+except ImportError:
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+    import instrument
 
 
 # takes a path and returns list of paths that match that path
@@ -25,25 +36,32 @@ def filelist(pathspec):
 
 
 # takes a path to an XML file and returns the text from <title> and
-# <text>, including all <p> objects found within <text>
+# <text>, including all <p> objects found within <text>. the file is
+# read with iterparse in a single pass, each element is cleared once its
+# text is taken so the whole tree is never held, and the pieces are
+# joined once at the end, titles first, then texts, then paragraphs.
+# each piece gets its slot on the element's start event (document order,
+# like the './/' searches, even for a <p> inside a <p>) and its text on
+# the end event. the root element itself is skipped, like the './/'
+# searches skip it
 
+@instrument.profiled()
 def get_text(fileName):
-    tree = ET.ElementTree(file = fileName)
-    # you can simplify this quite a bit. for example, there is only one title so there's no point in doing a loop around Roots
-    # also, do a search like we did in class:
-#    	for t in tree.iterfind('.//text//*'):
-
-    Roots = tree.findall('.//title')
-    text = ''
-    for element in Roots:
-        text = text + ' ' + element.text
-    Roots = tree.findall('.//text')
-    for element in Roots:
-        text = text + ' ' + element.text
-    Roots = tree.findall('.//p')
-    for element in Roots:
-        text = text + ' ' + element.text
-    return text
+    parts = {'title': [], 'text': [], 'p': []}
+    slots = []
+    for event, element in ET.iterparse(fileName, events=('start', 'end')):
+        if event == 'start':
+            if slots and element.tag in parts:
+                slots.append(len(parts[element.tag]))
+                parts[element.tag].append('')
+            else:
+                slots.append(None)
+            continue
+        slot = slots.pop()
+        if slot is not None:
+            parts[element.tag][slot] = element.text or ''
+        element.clear()
+    return ''.join(' ' + t for t in parts['title'] + parts['text'] + parts['p'])
 
 
 # takes a long string, strips out all numbers, punctuation,
@@ -51,6 +69,7 @@ def get_text(fileName):
 # by space into list of words, remove all words smaller than 3 letter,
 # make all words lower case, and return non-unique list of words
 
+@instrument.profiled(items=len)
 def words(doc):
     text = re.sub('[^A-Za-z]', ' ', doc)
     text = text.split()
@@ -68,8 +87,47 @@ def words(doc):
 # word's text frequency), so it's a map mapping files
 # to their text frequency maps (which themselves are mapping
 # words to that word's text frequency). the df is the
-# document frequency of all the words in all the files
-def create_indexes(listoffiles):
+# document frequency of all the words in all the files.
+# with workers > 1 the files are split into chunks of chunksize
+# that a process pool parses and tokenizes with index_files, the
+# partial tf maps and df counters are merged in chunk order.
+# tokencache can be a TokenCache (from tokencache.py at the top of the
+# repo), then files are only parsed and tokenized if the cache doesn't
+# have them yet and their words are read back from it
+@instrument.profiled(items=lambda result: len(result[0]))
+def create_indexes(listoffiles, workers=1, chunksize=64, tokencache=None):
+    if tokencache is not None:
+        return cached_indexes(listoffiles, tokencache, workers, chunksize)
+    if workers <= 1:
+        return index_files(listoffiles)
+    df = Counter()
+    tf_map = {}
+    for part_tf, part_df in map_chunks(index_files, listoffiles, workers, chunksize):
+        tf_map.update(part_tf)
+        df.update(part_df)
+    return (tf_map, df)
+
+# calls func on chunks of chunksize files from listoffiles in a pool of
+# workers processes and yields the results in chunk order, with one
+# worker the chunks are done one at a time in this process, so either
+# way only the results of a few chunks are held at once
+def map_chunks(func, listoffiles, workers=1, chunksize=64):
+    chunks = [listoffiles[i:i + chunksize] for i in range(0, len(listoffiles), chunksize)]
+    if workers <= 1:
+        for chunk in chunks:
+            yield func(chunk)
+        return
+    pool = multiprocessing.Pool(workers)
+    try:
+        for result in pool.imap(func, chunks):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+# the serial body of create_indexes: returns (tf_map, df) for a list of files
+def index_files(listoffiles):
     df = Counter()
     tf_map = {}
     for f in listoffiles:
@@ -83,6 +141,34 @@ def create_indexes(listoffiles):
         tf_map[f] = tf
     return (tf_map, df)
 
+# index_files for the words of the files in tokencache, tokenizing
+# the ones it doesn't have (with workers processes) first
+def cached_indexes(listoffiles, tokencache, workers=1, chunksize=64):
+    tokencache.update(listoffiles, 'tfidf', file_words, workers, chunksize)
+    df = Counter()
+    tf_map = {}
+    for f in listoffiles:
+        tf = tokencache.counts(f, 'tfidf', file_words)
+        n = float(sum(tf.values()))
+        for t in tf:
+            tf[t] = tf[t]/n
+            df[t] += 1
+        tf_map[f] = tf
+    return (tf_map, df)
+
+# the words of an XML file, the tokenizer cached_indexes caches
+def file_words(fileName):
+    return words(get_text(fileName))
+
+# like index_files but keeps raw counts: returns a list of
+# (file, Counter of term counts, number of words) for a list of files
+def count_files(listoffiles):
+    counts = []
+    for f in listoffiles:
+        text = words(get_text(f))
+        counts.append((f, Counter(text), len(text)))
+    return counts
+
 # takes a single tf (which is a single file's map of all
 # it's terms mapped to all of those term's frequencies...)
 # and converts that map into a tfidf map, which is a map
@@ -106,13 +192,520 @@ def doc_tfidf(tf, df, N):
 # mapped to it's tfidf score), requires the create_indexes
 # function above to be used with the files, and the
 # doc_tfidif function in the loop, to be used with each
-# document's individual tf map from the result of create_indexes
+# document's individual tf map from the result of create_indexes,
+# workers and tokencache are passed on to create_indexes
 
-def create_tfidf_map(files):
-    (tf_map, df) = create_indexes(files)
+@instrument.profiled(items=len)
+def create_tfidf_map(files, workers=1, tokencache=None):
+    (tf_map, df) = create_indexes(files, workers, tokencache=tokencache)
     tfidf_map = {}
     N = len(files)
     for f in files:
         tfidf = doc_tfidf(tf_map[f], df, N)
         tfidf_map[f] = tfidf
     return tfidf_map
+
+
+# same scores as create_tfidf_map, but as a sparse matrix: returns
+# (matrix, vocabulary, rows) where matrix is a scipy CSR matrix with one
+# row per file and one column per term, vocabulary maps each term to its
+# column and rows lists the file of each row. the idf of every term is
+# computed once as a vector and applied to all the tf values in one
+# multiply. the values are computed in float64 exactly like doc_tfidf and
+# then stored as dtype (float32 by default, pass np.float64 to keep the
+# dict scores bit for bit). with n_features set the terms are hashed into
+# that many columns instead (see create_hashed_indexes) and vocabulary is
+# None, since there is no term -> column map to keep. tokencache is
+# passed on to create_indexes
+
+@instrument.profiled(items=lambda result: result[0].shape[0])
+def create_tfidf_matrix(files, workers=1, dtype=np.float32, n_features=None, signed=False,
+                        tokencache=None):
+    if n_features is not None:
+        (docs, df) = create_hashed_indexes(files, n_features, signed, workers)
+        return (hashed_to_matrix(docs, df, dtype), None, list(files))
+    (tf_map, df) = create_indexes(files, workers, tokencache=tokencache)
+    return indexes_to_matrix(tf_map, df, files, dtype)
+
+# the matrix half of create_tfidf_matrix, for a tf_map and df that are
+# already built (by create_indexes or load_index)
+def indexes_to_matrix(tf_map, df, files, dtype=np.float32):
+    terms = sorted(df)
+    vocabulary = dict((t, i) for i, t in enumerate(terms))
+    idf = idf_vector(df, terms, len(files))
+    indptr = [0]
+    indices = []
+    tf = []
+    for f in files:
+        for t, value in tf_map[f].items():
+            indices.append(vocabulary[t])
+            tf.append(value)
+        indptr.append(len(indices))
+    indices = np.array(indices, dtype=np.int32)
+    values = (np.array(tf, dtype=np.float64) * idf[indices]).astype(dtype)
+    matrix = sparse.csr_matrix((values, indices, np.array(indptr, dtype=np.int64)),
+                               shape=(len(files), len(terms)))
+    matrix.sort_indices()
+    return (matrix, vocabulary, list(files))
+
+
+# hashing-trick version of create_indexes with a fixed memory ceiling:
+# every term from words goes to bucket term_hash(term) % n_features, and
+# nothing keyed on the term itself is kept. returns (docs, df) where docs
+# has a (file, buckets, counts, number of words) tuple per file (buckets
+# and counts are integer arrays) and df is an integer array of the number
+# of files each bucket occurs in. with signed, each term's count is added
+# with a +1/-1 sign taken from another bit of its hash, so colliding terms
+# tend to cancel instead of always piling up
+
+@instrument.profiled(items=lambda result: len(result[0]))
+def create_hashed_indexes(listoffiles, n_features=2**20, signed=False, workers=1, chunksize=64):
+    docs = []
+    df = np.zeros(n_features, dtype=np.int64)
+    func = functools.partial(hash_files, n_features=n_features, signed=signed)
+    for part in map_chunks(func, listoffiles, workers, chunksize):
+        for doc in part:
+            df[doc[1]] += 1
+        docs.extend(part)
+    return (docs, df)
+
+# the per-chunk body of create_hashed_indexes
+def hash_files(listoffiles, n_features=2**20, signed=False):
+    docs = []
+    for f in listoffiles:
+        text = words(get_text(f))
+        tf = Counter(text)
+        hashes = np.array([term_hash(t) for t in tf], dtype=np.int64)
+        counts = np.array(list(tf.values()), dtype=np.int64)
+        if signed:
+            counts = np.where(hashes >> 31 & 1, -counts, counts)
+        buckets, inverse = np.unique(hashes % n_features, return_inverse=True)
+        values = np.bincount(inverse, weights=counts, minlength=len(buckets)).astype(np.int64)
+        docs.append((f, buckets, values, len(text)))
+    return docs
+
+# a stable 32 bit hash of a term (crc32 of its bytes), unlike hash() it is
+# the same in every process and every run
+def term_hash(t):
+    return zlib.crc32(t.encode('utf-8')) & 0xffffffff
+
+# the matrix half of the hashed create_tfidf_matrix: one row per doc of
+# docs, tf is the (signed) bucket count over the number of words, idf is
+# computed from the bucket df like for terms
+def hashed_to_matrix(docs, df, dtype=np.float32):
+    N = float(len(docs))
+    idf = np.zeros(len(df))
+    seen = df > 0
+    idf[seen] = np.log(1/(df[seen]/N))
+    indptr = np.zeros(len(docs) + 1, dtype=np.int64)
+    np.cumsum([len(doc[1]) for doc in docs], out=indptr[1:])
+    if docs:
+        indices = np.concatenate([doc[1] for doc in docs]).astype(np.int32)
+        values = np.concatenate([doc[2]/float(doc[3]) for doc in docs])
+    else:
+        indices = np.zeros(0, dtype=np.int32)
+        values = np.zeros(0)
+    return sparse.csr_matrix(((values * idf[indices]).astype(dtype), indices, indptr),
+                             shape=(len(docs), len(df)))
+
+# the idf of each of terms as a float64 vector, computed the same way
+# doc_tfidf does for a single term
+def idf_vector(df, terms, N):
+    dft = np.array([df[t] for t in terms], dtype=np.float64)/float(N)
+    return np.log(1/dft)
+
+
+# out-of-core version of create_tfidf_matrix for corpora that don't fit in
+# memory, everything goes to files in outdir:
+#   pass one parses the files (in a pool of workers processes, as in
+#   create_indexes) and keeps only the df, the term -> id map and the
+#   doc -> file list, the (term id, count) pairs of each document are
+#   buffered and spilled to spill-NNNNN.npz once they take memory bytes
+#   pass two reads the spill files back one at a time, applies the idf and
+#   writes each one out as a CSR chunk tfidf-NNNNN.npz, then removes it
+# the scores are the same as create_tfidf_matrix's (same sorted term
+# columns, or hashed columns with n_features set, in which case no term is
+# kept at all), rows.txt lists the file of each row and terms.txt the term
+# of each column. returns the list of chunk paths, read them back with
+# read_tfidf_chunks and load_chunk_vocabulary
+
+@instrument.profiled()
+def create_tfidf_chunks(files, outdir, memory=2**26, workers=1, chunksize=64,
+                        dtype=np.float32, n_features=None, signed=False):
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    for old in glob.glob(os.path.join(outdir, 'tfidf-*.npz')) + glob.glob(os.path.join(outdir, 'terms.txt')):
+        os.remove(old)
+    # pass one: df and spill files
+    if n_features is None:
+        func = count_files
+        term_ids = {}
+        df = []
+    else:
+        func = functools.partial(hash_files, n_features=n_features, signed=signed)
+        term_ids = None
+        df = np.zeros(n_features, dtype=np.int64)
+    spills = []
+    buffered = []
+    size = 0
+    rows = open(os.path.join(outdir, 'rows.txt'), 'w')
+    try:
+        for part in map_chunks(func, files, workers, chunksize):
+            for f, tf, counts, n in spill_docs(part, term_ids, df):
+                rows.write(f + '\n')
+                buffered.append((tf, counts, n))
+                size += 8 * len(tf) + 8
+                if size >= memory:
+                    spills.append(write_spill(outdir, len(spills), buffered))
+                    buffered = []
+                    size = 0
+    finally:
+        rows.close()
+    if buffered or not spills:
+        spills.append(write_spill(outdir, len(spills), buffered))
+    # pass two: idf and CSR chunks
+    N = float(len(files))
+    df = np.asarray(df, dtype=np.float64)
+    idf = np.zeros(len(df))
+    seen = df > 0
+    idf[seen] = np.log(1/(df[seen]/N))
+    if term_ids is None:
+        columns = np.arange(len(df))
+    else:
+        terms = sorted(term_ids)
+        columns = np.zeros(len(terms), dtype=np.int32)
+        columns[[term_ids[t] for t in terms]] = np.arange(len(terms))
+        write_terms(os.path.join(outdir, 'terms.txt'), terms)
+    chunks = []
+    for i, path in enumerate(spills):
+        spill = np.load(path)
+        indptr = spill['indptr']
+        ids = spill['terms']
+        lengths = np.repeat(spill['lengths'].astype(np.float64), np.diff(indptr))
+        values = (spill['counts']/lengths) * idf[ids]
+        matrix = sparse.csr_matrix((values.astype(dtype), columns[ids], indptr),
+                                   shape=(len(indptr) - 1, len(df)))
+        matrix.sort_indices()
+        spill.close()
+        chunk = os.path.join(outdir, 'tfidf-%05d.npz' % i)
+        sparse.save_npz(chunk, matrix, compressed=False)
+        os.remove(path)
+        chunks.append(chunk)
+    return chunks
+
+# turns the per-chunk results of count_files (or hash_files, when term_ids
+# is None) into (file, term ids, counts, number of words) per document,
+# giving new terms the next id and counting every term once in df
+def spill_docs(part, term_ids, df):
+    for doc in part:
+        if term_ids is None:
+            (f, ids, counts, n) = doc
+            df[ids] += 1
+        else:
+            (f, tf, n) = doc
+            ids = np.zeros(len(tf), dtype=np.int32)
+            counts = np.zeros(len(tf), dtype=np.int32)
+            for j, (t, count) in enumerate(tf.items()):
+                if t not in term_ids:
+                    term_ids[t] = len(df)
+                    df.append(0)
+                df[term_ids[t]] += 1
+                ids[j] = term_ids[t]
+                counts[j] = count
+        yield (f, ids, counts, n)
+
+# writes the buffered (term ids, counts, number of words) documents to
+# spill-NNNNN.npz in outdir as flat int32 arrays plus a row pointer
+def write_spill(outdir, number, buffered):
+    path = os.path.join(outdir, 'spill-%05d.npz' % number)
+    indptr = np.zeros(len(buffered) + 1, dtype=np.int64)
+    np.cumsum([len(doc[0]) for doc in buffered], out=indptr[1:])
+    if buffered:
+        ids = np.concatenate([doc[0] for doc in buffered]).astype(np.int32)
+        counts = np.concatenate([doc[1] for doc in buffered]).astype(np.int32)
+    else:
+        ids = np.zeros(0, dtype=np.int32)
+        counts = np.zeros(0, dtype=np.int32)
+    lengths = np.array([doc[2] for doc in buffered], dtype=np.int64)
+    np.savez(path, indptr=indptr, terms=ids, counts=counts, lengths=lengths)
+    return path
+
+def write_terms(path, terms):
+    out = open(path, 'wb')
+    try:
+        for t in terms:
+            out.write(t.encode('utf-8') + b'\n')
+    finally:
+        out.close()
+
+# yields (matrix, rows) for each chunk create_tfidf_chunks wrote to outdir,
+# in order, rows being the files of the chunk's rows
+def read_tfidf_chunks(outdir):
+    rows = open(os.path.join(outdir, 'rows.txt'))
+    try:
+        for chunk in sorted(glob.glob(os.path.join(outdir, 'tfidf-*.npz'))):
+            matrix = sparse.load_npz(chunk)
+            yield (matrix, [rows.readline().rstrip('\n') for i in range(matrix.shape[0])])
+    finally:
+        rows.close()
+
+# the term -> column map of the chunks in outdir, None if they were hashed
+def load_chunk_vocabulary(outdir):
+    path = os.path.join(outdir, 'terms.txt')
+    if not os.path.exists(path):
+        return None
+    terms = open(path, 'rb')
+    try:
+        return dict((t.rstrip(b'\n').decode('utf-8'), i) for i, t in enumerate(terms))
+    finally:
+        terms.close()
+
+
+# an on-disk index (a sqlite database at indexpath) that keeps the raw
+# term counts and word count of every indexed file, the global df, and
+# each file's size and mtime, so a re-index only parses what changed:
+#   docs(id, path, size, mtime, length)
+#   terms(id, term, df)
+#   counts(doc, term, count)
+INDEX_VERSION = 1
+
+def open_index(indexpath):
+    db = sqlite3.connect(indexpath)
+    db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+    row = db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+    if row is None:
+        db.execute("INSERT INTO meta VALUES ('version', ?)", (str(INDEX_VERSION),))
+    elif int(row[0]) != INDEX_VERSION:
+        raise ValueError('%s has index version %s, expected %d' % (indexpath, row[0], INDEX_VERSION))
+    db.execute('CREATE TABLE IF NOT EXISTS docs (id INTEGER PRIMARY KEY, path TEXT UNIQUE, '
+               'size INTEGER, mtime REAL, length INTEGER)')
+    db.execute('CREATE TABLE IF NOT EXISTS terms (id INTEGER PRIMARY KEY, term TEXT UNIQUE, '
+               'df INTEGER)')
+    db.execute('CREATE TABLE IF NOT EXISTS counts (doc INTEGER, term INTEGER, count INTEGER, '
+               'PRIMARY KEY (doc, term))')
+    db.commit()
+    return db
+
+# brings the index at indexpath up to date with listoffiles (like we
+# would get from filelist): files that are gone or whose size or mtime
+# changed have their df contributions subtracted and are dropped, then
+# new and changed files are parsed chunksize at a time (in a pool of
+# workers processes, as in create_indexes) and added, so only a few
+# chunks of term counts are held at once even on the first build.
+# returns (added, removed), the number of files parsed and the number
+# dropped, a changed file counts as both
+
+@instrument.profiled()
+def update_index(indexpath, listoffiles, workers=1, chunksize=64):
+    db = open_index(indexpath)
+    known = {}
+    for doc, path, size, mtime in db.execute('SELECT id, path, size, mtime FROM docs'):
+        known[path] = (doc, size, mtime)
+    current = {}
+    for f in listoffiles:
+        current[f] = (os.path.getsize(f), os.path.getmtime(f))
+    stale = [known[f][0] for f in known if current.get(f) != known[f][1:]]
+    fresh = [f for f in listoffiles if f not in known or current[f] != known[f][1:]]
+    for doc in stale:
+        db.execute('UPDATE terms SET df = df - 1 WHERE id IN '
+                   '(SELECT term FROM counts WHERE doc = ?)', (doc,))
+        db.execute('DELETE FROM counts WHERE doc = ?', (doc,))
+        db.execute('DELETE FROM docs WHERE id = ?', (doc,))
+    db.execute('DELETE FROM terms WHERE df <= 0')
+    term_ids = dict(db.execute('SELECT term, id FROM terms'))
+    df_added = Counter()
+    for counts in map_chunks(count_files, fresh, workers, chunksize):
+        for f, tf, n in counts:
+            size, mtime = current[f]
+            doc = db.execute('INSERT INTO docs (path, size, mtime, length) VALUES (?, ?, ?, ?)',
+                             (f, size, mtime, n)).lastrowid
+            rows = []
+            for t, count in tf.items():
+                if t not in term_ids:
+                    term_ids[t] = db.execute('INSERT INTO terms (term, df) VALUES (?, 0)',
+                                             (t,)).lastrowid
+                rows.append((doc, term_ids[t], count))
+                df_added[term_ids[t]] += 1
+            db.executemany('INSERT INTO counts VALUES (?, ?, ?)', rows)
+    db.executemany('UPDATE terms SET df = df + ? WHERE id = ?',
+                   [(n, term) for term, n in df_added.items()])
+    db.commit()
+    db.close()
+    return (len(fresh), len(stale))
+
+# reads the index at indexpath back as (tf_map, df, files), the same
+# tf_map and df create_indexes builds for the indexed files (files is
+# their sorted list), ready for doc_tfidf or indexes_to_matrix
+
+@instrument.profiled()
+def load_index(indexpath):
+    db = open_index(indexpath)
+    df = Counter(dict(db.execute('SELECT term, df FROM terms')))
+    docs = {}
+    tf_map = {}
+    for doc, path, length in db.execute('SELECT id, path, length FROM docs'):
+        docs[doc] = (path, float(length))
+        tf_map[path] = Counter()
+    query = 'SELECT counts.doc, terms.term, counts.count FROM counts JOIN terms ON terms.id = counts.term'
+    for doc, t, count in db.execute(query):
+        path, n = docs[doc]
+        tf_map[path][t] = count/n
+    db.close()
+    return (tf_map, df, sorted(tf_map))
+
+# create_tfidf_map for the files in the index at indexpath, without
+# parsing any of them
+
+def index_tfidf_map(indexpath):
+    (tf_map, df, files) = load_index(indexpath)
+    tfidf_map = {}
+    N = len(files)
+    for f in files:
+        tfidf_map[f] = doc_tfidf(tf_map[f], df, N)
+    return tfidf_map
+
+
+# top-k cosine similarity search over the tf-idf vectors of a corpus.
+# the vectors are normalized once and stored by term (a csc matrix, so the
+# column of a term is its postings: the documents containing it, sorted,
+# with their normalized weight), and a query only touches the postings of
+# its own terms. the scores are added up in one dense array over all the
+# documents, a batch of columns at a time, with the terms in decreasing
+# order of their best possible contribution. after each batch the current
+# k-th score is taken, and once no document that hasn't been seen yet
+# could still make the top k (the sum of the remaining terms' bounds is
+# below it), the remaining postings are only used to finish the scores of
+# the documents still in the running (max-score pruning). the batches
+# start at FIRST_BATCH terms and double, so long queries (a whole document)
+# take a handful of checks. documents that share no weighted term with the
+# query (similarity 0) are never returned
+
+class SearchIndex(object):
+
+    # how many query terms are scored before the first check of the k-th score
+    FIRST_BATCH = 32
+    # batches with more postings than this are added up by scipy (see add_postings)
+    SLICE_ABOVE = 25000
+
+    # matrix, vocabulary and rows as returned by indexes_to_matrix,
+    # idf is the idf vector of the vocabulary's terms in column order
+    def __init__(self, matrix, vocabulary, rows, idf):
+        matrix = sparse.csr_matrix(matrix, dtype=np.float64)
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        scale = np.zeros(len(norms))
+        np.divide(1.0, norms, out=scale, where=norms > 0)
+        postings = sparse.csc_matrix(sparse.diags(scale).dot(matrix))
+        postings.eliminate_zeros()
+        postings.sort_indices()
+        self.postings = postings
+        self.maxweights = np.zeros(postings.shape[1])
+        nonempty = np.diff(postings.indptr) > 0
+        if nonempty.any():
+            self.maxweights[nonempty] = np.maximum.reduceat(postings.data, postings.indptr[:-1][nonempty])
+        self.vocabulary = vocabulary
+        self.rows = rows
+        self.idf = idf
+
+    # builds the index straight from a list of files (as from filelist)
+    @classmethod
+    def from_files(cls, files, workers=1):
+        (tf_map, df) = create_indexes(files, workers)
+        return cls.from_indexes(tf_map, df, files)
+
+    # builds the index from the on-disk index at indexpath (see update_index)
+    @classmethod
+    def from_index(cls, indexpath):
+        (tf_map, df, files) = load_index(indexpath)
+        return cls.from_indexes(tf_map, df, files)
+
+    @classmethod
+    def from_indexes(cls, tf_map, df, files):
+        (matrix, vocabulary, rows) = indexes_to_matrix(tf_map, df, files, np.float64)
+        return cls(matrix, vocabulary, rows, idf_vector(df, sorted(df), len(files)))
+
+    # returns the k files most cosine-similar to the free text query, as a
+    # list of (file, similarity) pairs, best first. query words that are
+    # not in the corpus are ignored
+    def query(self, text, k=10):
+        return self.query_words(words(text), k)
+
+    # like query, for the text of an XML file (read with get_text); a file
+    # that is itself indexed will come back as its own best match
+    def query_file(self, fileName, k=10):
+        return self.query_words(words(get_text(fileName)), k)
+
+    @instrument.profiled('SearchIndex.query_words')
+    def query_words(self, querywords, k=10):
+        (terms, qweights, qnorm) = self.query_vector(querywords)
+        if qnorm == 0 or k <= 0:
+            return []
+        bounds = qweights * self.maxweights[terms]
+        order = np.argsort(-bounds, kind='mergesort')
+        (terms, qweights) = (terms[order], qweights[order])
+        remaining = np.append(np.cumsum(bounds[order][::-1])[::-1], 0)
+        scores = np.zeros(len(self.rows))
+        (i, batch) = (0, self.FIRST_BATCH)
+        while i < len(terms):
+            # add the next batch of terms into the dense scores, then see if
+            # anything not scored yet could still make the top k
+            j = min(i + batch, len(terms))
+            self.add_postings(scores, terms[i:j], qweights[i:j])
+            (i, batch) = (j, 2 * batch)
+            if k < len(scores):
+                threshold = np.partition(scores, len(scores) - k)[len(scores) - k]
+                if threshold > 0 and remaining[i] < threshold:
+                    break
+        cand_docs = np.flatnonzero(scores > 0)
+        if i < len(terms):
+            # nothing new can make the top k: drop the candidates that can't
+            # either, and only finish the scores of the rest
+            cand_docs = cand_docs[scores[cand_docs] + remaining[i] >= threshold]
+            slots = np.full(len(scores), -1, dtype=np.int64)
+            slots[cand_docs] = np.arange(len(cand_docs))
+            tail = self.postings[:, terms[i:]]
+            docs = slots[tail.indices]
+            weights = np.repeat(qweights[i:], np.diff(tail.indptr)) * tail.data
+            hit = docs >= 0
+            cand_scores = scores[cand_docs] + np.bincount(docs[hit], weights=weights[hit],
+                                                          minlength=len(cand_docs))
+        else:
+            cand_scores = scores[cand_docs]
+        best = np.lexsort((cand_docs, -cand_scores))[:k]
+        return [(self.rows[d], s/qnorm) for d, s in zip(cand_docs[best], cand_scores[best].tolist())]
+
+    # adds the postings of terms, times their query weights, into scores.
+    # scipy's column slicing costs a fixed ~0.2ms per call but runs the
+    # product in c, so only batches with more than SLICE_ABOVE postings go
+    # through it and smaller ones are gathered and added up with numpy
+    def add_postings(self, scores, terms, qweights):
+        starts = self.postings.indptr[terms]
+        lengths = self.postings.indptr[terms + 1] - starts
+        if lengths.sum() > self.SLICE_ABOVE:
+            scores += self.postings[:, terms].dot(qweights)
+            return
+        index = np.arange(lengths.sum()) + np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        scores += np.bincount(self.postings.indices[index],
+                              weights=np.repeat(qweights, lengths) * self.postings.data[index],
+                              minlength=len(scores))
+
+    # the column of each query word found in the corpus, its tf-idf weight
+    # and the norm of those weights (0 when none was found)
+    def query_vector(self, querywords):
+        tf = [(self.vocabulary[t], c) for t, c in Counter(querywords).items() if t in self.vocabulary]
+        n = float(len(querywords))
+        terms = np.array([t for t, c in tf], dtype=np.int64)
+        qweights = np.array([c/n for t, c in tf]) * self.idf[terms]
+        return (terms, qweights, float(np.sqrt(np.dot(qweights, qweights))))
+
+    # query_words by brute force, scoring every document with one sparse
+    # matrix-vector product, to check query_words against
+    def scan_words(self, querywords, k=10):
+        (terms, qweights, qnorm) = self.query_vector(querywords)
+        if qnorm == 0 or k <= 0:
+            return []
+        q = np.zeros(len(self.maxweights))
+        q[terms] = qweights
+        scores = self.postings.dot(q)
+        cand_docs = np.flatnonzero(scores > 0)
+        best = np.lexsort((cand_docs, -scores[cand_docs]))[:k]
+        return [(self.rows[d], s/qnorm) for d, s in zip(cand_docs[best], scores[cand_docs[best]].tolist())]
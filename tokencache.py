@@ -0,0 +1,161 @@
+import hashlib
+import multiprocessing
+import os
+import sqlite3
+from collections import Counter
+import numpy as np
+
+
+# a tokenization cache on disk, shared by the tfidf and naive bayes code.
+# every document is tokenized once per tokenizer and its words are kept as
+# int32 ids into a vocabulary shared by all the documents and tokenizers:
+#   directory/catalog.sqlite  words(id, word) and
+#                             docs(path, tokenizer, digest, offset, length)
+#   directory/tokens.bin      the ids of all the documents back to back,
+#                             read through a memory map
+# a document is looked up by its path and the tokenizer's name, and is only
+# a hit if the sha1 digest of the file's contents is still the same, so
+# editing a file invalidates it. a document that was re-tokenized leaves its
+# old ids behind in tokens.bin, only one process should write to a cache
+# at a time
+
+CACHE_VERSION = 1
+
+class TokenCache(object):
+
+    def __init__(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.tokenpath = os.path.join(directory, 'tokens.bin')
+        self.db = sqlite3.connect(os.path.join(directory, 'catalog.sqlite'))
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is None:
+            self.db.execute("INSERT INTO meta VALUES ('version', ?)", (str(CACHE_VERSION),))
+        elif int(row[0]) != CACHE_VERSION:
+            raise ValueError('%s has cache version %s, expected %d' % (directory, row[0], CACHE_VERSION))
+        self.db.execute('CREATE TABLE IF NOT EXISTS words (id INTEGER PRIMARY KEY, word TEXT UNIQUE)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS docs (path TEXT, tokenizer TEXT, digest TEXT, '
+                        'offset INTEGER, length INTEGER, PRIMARY KEY (path, tokenizer))')
+        self.db.commit()
+        self.words = [word for (word,) in self.db.execute('SELECT word FROM words ORDER BY id')]
+        self.vocabulary = dict((w, i) for i, w in enumerate(self.words))
+        if not os.path.exists(self.tokenpath):
+            open(self.tokenpath, 'wb').close()
+        self.tokens = None
+        self.checked = {}
+
+    def close(self):
+        self.db.close()
+        self.tokens = None
+
+    # the token ids of path for the tokenizer called name, an int32 array
+    # (a view of the memory map), tokenized with func(path) -> list of
+    # words and added to the cache if it isn't there or the file changed.
+    # files that update already checked are not hashed again
+    def ids(self, path, name, func):
+        found = self.checked.get((path, name))
+        if found is None:
+            digest = file_digest(path)
+            found = self.lookup(path, name, digest)
+            if found is None:
+                found = self.store(path, name, digest, func(path))
+        return self.read(*found)
+
+    # the words of path counted into a Counter, the same Counter as
+    # Counter(func(path))
+    def counts(self, path, name, func):
+        ids, n = np.unique(self.ids(path, name, func), return_counts=True)
+        return Counter(dict((self.words[i], c) for i, c in zip(ids.tolist(), n.tolist())))
+
+    # makes sure every file of listoffiles is in the cache for the tokenizer
+    # called name, tokenizing the missing ones with func (a module level
+    # function, so it can be sent to a pool of workers processes).
+    # returns the number of files that were tokenized
+    def update(self, listoffiles, name, func, workers=1, chunksize=64):
+        missing = []
+        for path in listoffiles:
+            digest = file_digest(path)
+            if self.lookup(path, name, digest) is None:
+                missing.append((path, digest))
+        jobs = [(func, path) for path, digest in missing]
+        if workers <= 1:
+            self.store_all(name, missing, (tokenize_job(job) for job in jobs))
+        else:
+            pool = multiprocessing.Pool(workers)
+            try:
+                self.store_all(name, missing, pool.imap(tokenize_job, jobs, chunksize))
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        return len(missing)
+
+    def store_all(self, name, missing, results):
+        for (path, digest), words in zip(missing, results):
+            self.store(path, name, digest, words, commit=False)
+        self.db.commit()
+
+    # (offset, length) of the ids of path if the cache has it with the
+    # given digest, else None
+    def lookup(self, path, name, digest):
+        row = self.db.execute('SELECT digest, offset, length FROM docs WHERE path = ? AND tokenizer = ?',
+                              (path, name)).fetchone()
+        if row is None or row[0] != digest:
+            return None
+        self.checked[(path, name)] = (row[1], row[2])
+        return (row[1], row[2])
+
+    # interns words, appends their ids to tokens.bin and records them as
+    # the tokens of path for the tokenizer called name, returns their
+    # (offset, length)
+    def store(self, path, name, digest, words, commit=True):
+        ids = np.zeros(len(words), dtype=np.int32)
+        for j, w in enumerate(words):
+            i = self.vocabulary.get(w)
+            if i is None:
+                i = self.vocabulary[w] = len(self.words)
+                self.words.append(w)
+                self.db.execute('INSERT INTO words (id, word) VALUES (?, ?)', (i, w))
+            ids[j] = i
+        out = open(self.tokenpath, 'ab')
+        try:
+            out.seek(0, os.SEEK_END)
+            offset = out.tell() // 4
+            out.write(ids.tobytes())
+        finally:
+            out.close()
+        self.db.execute('INSERT OR REPLACE INTO docs VALUES (?, ?, ?, ?, ?)',
+                        (path, name, digest, offset, len(ids)))
+        if commit:
+            self.db.commit()
+        self.checked[(path, name)] = (offset, len(ids))
+        return (offset, len(ids))
+
+    # length ids starting at offset, the memory map is remade when the
+    # file has grown past it
+    def read(self, offset, length):
+        if length == 0:
+            return np.zeros(0, dtype=np.int32)
+        if self.tokens is None or offset + length > len(self.tokens):
+            self.tokens = np.memmap(self.tokenpath, dtype=np.int32, mode='r')
+        return self.tokens[offset:offset + length]
+
+
+def tokenize_job(job):
+    func, path = job
+    return func(path)
+
+# the sha1 hex digest of the contents of the file at path
+def file_digest(path):
+    digest = hashlib.sha1()
+    f = open(path, 'rb')
+    try:
+        block = f.read(1 << 20)
+        while block:
+            digest.update(block)
+            block = f.read(1 << 20)
+    finally:
+        f.close()
+    return digest.hexdigest()